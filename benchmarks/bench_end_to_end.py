@@ -0,0 +1,332 @@
+"""
+Runs the scripts end to end, offline, against the fake services in benchmarks.fake_services. Reports for each
+scenario the wall time, images/min, peak memory (max RSS), and per service the request count, injected errors and
+client-side latency percentiles. Each scenario runs in its own process so that its peak memory is its own.
+
+Scenarios:
+  playlist     generate_playlist_prompt.py, answering its prompts until --images images are made
+  album        generate_alt_album_art_prompt.py, interrupted with Ctrl+C after --images images
+  batch        batch_generate_playlist_art.py over every fake playlist, with empty caches
+  batch-rerun  batch_generate_playlist_art.py again after --changed of the playlists changed (only this run is
+               measured, but peak memory covers both runs)
+
+To catch regressions, save a baseline on a known good commit and compare later runs with it. The exit status is 1
+if any metric is worse than the baseline by more than --tolerance:
+
+  python -m benchmarks.bench_end_to_end --save-baseline ../baseline.json
+  python -m benchmarks.bench_end_to_end --baseline ../baseline.json
+
+Run from the repository root: python -m benchmarks.bench_end_to_end
+"""
+import _thread
+import argparse
+import builtins
+import contextlib
+import io
+import json
+import math
+import os
+import resource
+import runpy
+import subprocess
+import sys
+import tempfile
+import threading
+from collections import Counter, defaultdict
+from time import perf_counter
+
+from requests.adapters import HTTPAdapter
+
+from benchmarks.fake_services import FakeLyrics, FakeOpenAI, FakeServices, FakeSpotify
+from benchmarks.mock_sd_server import MockStableDiffusion
+from src.imagewriter import image_writer
+from src.stablediffusionhandler import SDImage
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ('playlist', 'album', 'batch', 'batch-rerun')
+BATCH_ARGS = ['--user', 'benchmark']
+MIN_SECONDS = 0.05  # Timing differences below this are noise, whatever the tolerance
+
+
+class RequestRecorder:
+    """
+    Times every request sent with requests, which HttpSession and the openai library both use. For streamed
+    responses this is the time until the response headers arrive.
+    """
+
+    def __init__(self, services: FakeServices):
+        self._services = services
+        self._latencies: dict[str, list[float]] = defaultdict(list)
+        self._routes: dict[str, Counter] = defaultdict(Counter)
+        self._errors = Counter()
+        self._lock = threading.Lock()
+        self._original_send = None
+
+    def __enter__(self):
+        self._original_send = original_send = HTTPAdapter.send
+        recorder = self
+
+        def send(adapter, request, *args, **kwargs):
+            t0 = perf_counter()
+            response = original_send(adapter, request, *args, **kwargs)
+            recorder.record(request.url, response.status_code, perf_counter() - t0)
+            return response
+
+        HTTPAdapter.send = send
+        return self
+
+    def __exit__(self, *exc_info):
+        HTTPAdapter.send = self._original_send
+
+    def reset(self):
+        with self._lock:
+            self._latencies.clear()
+            self._routes.clear()
+            self._errors.clear()
+
+    def record(self, url, status, seconds):
+        service = self._services.service_for(url)
+        if service is None:
+            return
+        name, route = service
+        with self._lock:
+            self._latencies[name].append(seconds)
+            self._routes[name][route] += 1
+            if status == 429 or status >= 500:
+                self._errors[name] += 1
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {name: {
+                'requests': len(latencies),
+                'errors': self._errors[name],
+                'p50': _percentile(latencies, 50),
+                'p95': _percentile(latencies, 95),
+                'p99': _percentile(latencies, 99),
+                'max': max(latencies),
+                'routes': dict(self._routes[name].most_common()),
+            } for name, latencies in sorted(self._latencies.items())}
+
+
+def _percentile(values, q) -> float:
+    values = sorted(values)
+    return values[max(0, math.ceil(q / 100 * len(values)) - 1)]
+
+
+def _count_images(root) -> int:
+    images_dir = os.path.join(root, 'images')
+    return len(os.listdir(images_dir)) if os.path.isdir(images_dir) else 0
+
+
+def _run_script(root, script, argv=(), answers=(), stop_after_images=None, verbose=False) -> tuple[float, int]:
+    """
+    Runs a script in this process with scripted answers to its input() prompts and SDImage.show replaced. After
+    stop_after_images images have been shown the main thread is interrupted as if by Ctrl+C.
+    Returns the time taken and the number of images saved.
+    """
+    answers = list(answers)
+    shown = [0]
+    lock = threading.Lock()
+
+    def scripted_input(prompt=''):
+        if not answers:
+            raise EOFError(f'No scripted answer for {prompt!r}')
+        return answers.pop(0)
+
+    def show(image):
+        with lock:
+            shown[0] += 1
+            should_stop = shown[0] == stop_after_images
+        if should_stop:
+            _thread.interrupt_main()
+
+    saved = builtins.input, sys.argv
+    builtins.input, SDImage.show = scripted_input, show  # Not restored: images in flight may still be shown
+    sys.argv = [script, *argv]
+    images_before = _count_images(root)
+
+    t0 = perf_counter()
+    try:
+        with contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO()):
+            runpy.run_path(os.path.join(REPO_ROOT, 'scripts', script), run_name='__main__')
+    except SystemExit:
+        pass
+    finally:
+        image_writer.flush()
+        builtins.input, sys.argv = saved
+    return perf_counter() - t0, _count_images(root) - images_before
+
+
+def run_scenario(scenario, args) -> dict:
+    spotify = FakeSpotify(args.playlists, args.tracks, album_tracks=args.album_tracks, markets=args.markets,
+                          art_size=args.art_size)
+    services = FakeServices(
+        spotify, FakeLyrics(args.lyrics_lines, args.no_lyrics_rate),
+        FakeOpenAI(args.completion_words, args.token_latency, args.seed),
+        MockStableDiffusion(args.image_size, args.image_size, args.seconds_per_image, variants=1024),  # Unique images
+        latencies={'spotify': args.spotify_latency, 'lyrics': args.lyrics_latency, 'openai': args.openai_latency},
+        # openai 0.27 does not retry server errors and Stable Diffusion requests are not retried on them, so only
+        # the Spotify and lyrics services get them
+        error_rates={'spotify': args.error_rate, 'lyrics': args.error_rate},
+        jitter=args.jitter, seed=args.seed)
+
+    with tempfile.TemporaryDirectory() as root, services, RequestRecorder(services) as recorder:
+        os.makedirs(os.path.join(root, 'scripts'))
+        os.chdir(os.path.join(root, 'scripts'))  # The scripts keep caches and images in ../
+
+        if scenario == 'playlist':
+            answers = ['', '1'] + ['y'] * (args.images - 1) + ['n']
+            wall_time, images = _run_script(root, 'generate_playlist_prompt.py', answers=answers,
+                                            verbose=args.verbose)
+        elif scenario == 'album':
+            wall_time, images = _run_script(root, 'generate_alt_album_art_prompt.py', answers=['benchmark', ''],
+                                            stop_after_images=args.images, verbose=args.verbose)
+        elif scenario == 'batch':
+            wall_time, images = _run_script(root, 'batch_generate_playlist_art.py', BATCH_ARGS, verbose=args.verbose)
+        else:
+            _run_script(root, 'batch_generate_playlist_art.py', BATCH_ARGS, verbose=args.verbose)
+            spotify.change_playlists(args.changed, args.seed)
+            recorder.reset()
+            wall_time, images = _run_script(root, 'batch_generate_playlist_art.py', BATCH_ARGS, verbose=args.verbose)
+
+        services_summary = recorder.summary()
+        os.chdir(REPO_ROOT)
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        'wall_time': wall_time,
+        'images': images,
+        'images_per_minute': 60 * images / wall_time if wall_time else 0.0,
+        'peak_rss_mib': max_rss / 2 ** 20 if sys.platform == 'darwin' else max_rss / 2 ** 10,  # bytes on macOS
+        'services': services_summary,
+    }
+
+
+def _run_in_subprocess(scenario) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        result_file = os.path.join(directory, 'result.json')
+        command = [sys.executable, '-m', 'benchmarks.bench_end_to_end', *sys.argv[1:],
+                   '--run-scenario', scenario, '--result-file', result_file]
+        completed = subprocess.run(command, cwd=REPO_ROOT)
+        if completed.returncode != 0:
+            return {'error': f'exited with status {completed.returncode}'}
+        with open(result_file) as file:
+            return json.load(file)
+
+
+def _print_result(scenario, result):
+    if 'error' in result:
+        print(f'{scenario}: FAILED ({result["error"]})')
+        return
+
+    print(f'{scenario}: {result["images"]} images in {result["wall_time"]:.2f}s '
+          f'({result["images_per_minute"]:.1f} images/min), peak RSS {result["peak_rss_mib"]:.1f} MiB')
+    for name, service in result['services'].items():
+        print(f'  {name:>16}: {service["requests"]:5} requests {service["errors"]:3} errors   '
+              f'p50 {service["p50"]:.3f}s  p95 {service["p95"]:.3f}s  p99 {service["p99"]:.3f}s  '
+              f'max {service["max"]:.3f}s')
+
+
+def _metrics(result) -> dict[str, tuple[float, bool, float]]:
+    """
+    Comparable metrics as name: (value, higher_is_better, absolute_slack)
+    """
+    metrics = {
+        'wall_time': (result['wall_time'], False, MIN_SECONDS),
+        'peak_rss_mib': (result['peak_rss_mib'], False, 0.0),
+    }
+    if result['images']:
+        metrics['images_per_minute'] = (result['images_per_minute'], True, 0.0)
+    for name, service in result['services'].items():
+        metrics[f'{name}.requests'] = (service['requests'] - service['errors'], False, 0.0)
+        metrics[f'{name}.p95'] = (service['p95'], False, MIN_SECONDS)
+    return metrics
+
+
+def compare(results: dict, baseline: dict, tolerance) -> list[str]:
+    """
+    Returns a description of every metric that is worse than in the baseline by more than tolerance
+    """
+    regressions = []
+    for scenario, result in results.items():
+        if 'error' in result:
+            regressions.append(f'{scenario}: {result["error"]}')
+            continue
+        if scenario not in baseline or 'error' in baseline[scenario]:
+            continue
+
+        baseline_metrics = _metrics(baseline[scenario])
+        for name, (value, higher_is_better, slack) in _metrics(result).items():
+            if name not in baseline_metrics:
+                continue
+            base = baseline_metrics[name][0]
+            if higher_is_better:
+                is_worse = value < base * (1 - tolerance) - slack
+            else:
+                is_worse = value > base * (1 + tolerance) + slack
+            if is_worse:
+                regressions.append(f'{scenario} {name}: {value:.3f} (baseline {base:.3f})')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--images', type=int, default=4, help='Images to make in the interactive scenarios')
+    parser.add_argument('--changed', type=float, default=0.1, help='Fraction of playlists changed for batch-rerun')
+    parser.add_argument('--playlists', type=int, default=20)
+    parser.add_argument('--tracks', type=int, default=200, help='Tracks per playlist')
+    parser.add_argument('--album-tracks', type=int, default=12)
+    parser.add_argument('--markets', type=int, default=80, help='Pads Spotify payloads like available_markets does')
+    parser.add_argument('--art-size', type=int, default=640)
+    parser.add_argument('--lyrics-lines', type=int, default=40)
+    parser.add_argument('--no-lyrics-rate', type=float, default=0.2)
+    parser.add_argument('--completion-words', type=int, default=60)
+    parser.add_argument('--image-size', type=int, default=512)
+    parser.add_argument('--spotify-latency', type=float, default=0.05)
+    parser.add_argument('--lyrics-latency', type=float, default=0.1)
+    parser.add_argument('--openai-latency', type=float, default=0.3, help='Time to the first byte of a completion')
+    parser.add_argument('--token-latency', type=float, default=0.005)
+    parser.add_argument('--seconds-per-image', type=float, default=0.2, help='Simulated GPU time per image')
+    parser.add_argument('--jitter', type=float, default=0.5, help='Latency varies by up to this fraction')
+    parser.add_argument('--error-rate', type=float, default=0.02, help='Fraction of requests answered with 503')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='Write the results to this file')
+    parser.add_argument('--save-baseline', help='Write the results to this file as the baseline')
+    parser.add_argument('--baseline', help='Compare with this baseline and exit with status 1 on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed relative regression')
+    parser.add_argument('--verbose', action='store_true', help="Show the scripts' output")
+    parser.add_argument('--run-scenario', choices=SCENARIOS, help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_scenario:
+        sys.path.insert(0, REPO_ROOT)
+        result = run_scenario(args.run_scenario, args)
+        with open(args.result_file, 'w') as file:
+            json.dump(result, file)
+        return
+
+    results = {}
+    for scenario in args.scenarios:
+        results[scenario] = _run_in_subprocess(scenario)
+        _print_result(scenario, results[scenario])
+
+    for path in (args.json, args.save_baseline):
+        if path:
+            with open(path, 'w') as file:
+                json.dump(results, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            sys.exit(1)
+    elif any('error' in result for result in results.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""
+Compares pooled (HttpSession) and unpooled (bare requests.get) throughput against a local stub server.
+
+Run from the repository root: python -m benchmarks.bench_http_session
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from statistics import quantiles
+from time import perf_counter
+
+import requests
+
+from benchmarks.stubserver import StubServer
+from src.httpsession import HttpSession
+
+
+def _run(get, url, num_requests, concurrency) -> dict:
+    def timed_get(_):
+        t0 = perf_counter()
+        get(url).raise_for_status()
+        return perf_counter() - t0
+
+    t0 = perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(timed_get, range(num_requests)))
+    elapsed = perf_counter() - t0
+
+    percentiles = quantiles(latencies, n=100)
+    return {
+        'requests/s': num_requests / elapsed,
+        'p50 (ms)': percentiles[49] * 1000,
+        'p99 (ms)': percentiles[98] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=25)
+    parser.add_argument('--latency', type=float, default=0.0, help='Server-side delay per request in seconds')
+    args = parser.parse_args()
+
+    body = {'genres': ['indie rock', 'dream pop'] * 50}
+    session = HttpSession(pool_size=args.concurrency, max_per_host=args.concurrency)
+    paths = [('unpooled', requests.get), ('pooled', session.get)]
+
+    for name, get in paths:
+        with StubServer(body, latency=args.latency) as server:
+            stats = _run(get, server.url, args.requests, args.concurrency)
+            connections = server.connection_count
+        summary = ', '.join(f'{key}: {value:.1f}' for key, value in stats.items())
+        print(f'{name:>8}: {summary}, connections: {connections}')
+
+    session.close()
+
+
+if __name__ == '__main__':
+    main()
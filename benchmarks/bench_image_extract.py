@@ -0,0 +1,77 @@
+"""
+Time and allocations per image for decoding a txt2img response: the previous path, which re-uploaded every image to
+/png-info to recover its parameters, against StableDiffusion.extract_images.
+
+Run from the repository root: python -m benchmarks.bench_image_extract
+"""
+import argparse
+import base64
+import io
+import tracemalloc
+from time import perf_counter
+
+import requests
+from PIL import Image, PngImagePlugin
+
+from benchmarks.mock_sd_server import MockStableDiffusion
+from benchmarks.stubserver import StubServer
+from src.stablediffusionhandler import StableDiffusion
+
+
+def _legacy_extract_image(api_response, png_info_url):
+    image_byte_str = api_response['images'][0]
+    image_bytes = io.BytesIO(base64.b64decode(image_byte_str.split(",", 1)[0]))
+    image = Image.open(image_bytes)
+
+    png_payload = {
+        "image": "data:image/png;base64," + image_byte_str
+    }
+    png_response = requests.post(png_info_url, json=png_payload).json()
+
+    png_info = PngImagePlugin.PngInfo()
+    png_info.add_text("parameters", png_response.get("info"))
+    image.load()
+    return image
+
+
+def _extract_image(api_response):
+    image = StableDiffusion.extract_images(api_response)[0].image
+    image.load()
+    return image
+
+
+def _measure(extract, iterations) -> tuple[float, float]:
+    extract()  # Warm up
+    tracemalloc.start()
+    t0 = perf_counter()
+    for _ in range(iterations):
+        extract()
+    elapsed = perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed / iterations, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--size', type=int, default=1024)
+    args = parser.parse_args()
+
+    mock = MockStableDiffusion(args.size, args.size, seconds_per_image=0)
+    _, api_response = mock.respond('POST', '/sdapi/v1/txt2img', b'{"prompt": "benchmark"}')
+
+    with StubServer(respond=mock.respond) as server:
+        png_info_url = f'{server.url}sdapi/v1/png-info'
+        paths = [
+            ('png-info round trip', lambda: _legacy_extract_image(api_response, png_info_url)),
+            ('info field', lambda: _extract_image(api_response)),
+        ]
+        for name, extract in paths:
+            seconds, peak = _measure(extract, args.iterations)
+            print(f'{name:>20}: {seconds * 1000:.1f} ms/image, peak allocations {peak / 2 ** 20:.1f} MiB'
+                  f' ({args.size}x{args.size})')
+
+
+if __name__ == '__main__':
+    main()
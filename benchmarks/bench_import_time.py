@@ -0,0 +1,84 @@
+"""
+Measures how long importing each entry-point module takes, using the interpreter's own -X importtime report, in a
+fresh process each time. The exit status is 1 if any module takes longer than --budget-ms (best of --repeat runs),
+or if importing it loads one of the heavy dependencies that should only be imported on first use, so startup
+regressions fail loudly:
+
+  python -m benchmarks.bench_import_time --budget-ms 60
+
+Run from the repository root: python -m benchmarks.bench_import_time
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULES = (
+    'src.spotifyhandler',
+    'src.openaihandler',
+    'src.stablediffusionhandler',
+    'src.imagepipeline',
+    'src.genreestimator',
+    'src.lyricsservice',
+    'src.playlistsync',
+    'src.sddispatcher',
+    'src.phash',
+    'scripts.batch_generate_playlist_art',
+)
+HEAVY_MODULES = ('requests', 'PIL', 'numpy', 'openai', 'aiohttp', 'asyncio', 'secret', 'tiktoken', 'ijson')
+
+
+def measure(module) -> tuple[float, list[str]]:
+    """
+    Returns the module's cumulative import time in seconds and the heavy modules that importing it loaded
+    """
+    code = (f'import sys, json; import {module}; '
+            f'print(json.dumps([name for name in {HEAVY_MODULES!r} if name in sys.modules]))')
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=REPO_ROOT, capture_output=True,
+                             text=True, check=True)
+
+    # Lines look like 'import time:   self [us] | cumulative | imported package', nested imports indented
+    cumulative_us = None
+    for line in process.stderr.splitlines():
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].rstrip() == f' {module}':
+            cumulative_us = int(fields[1])
+    return cumulative_us / 1e6, json.loads(process.stdout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modules', nargs='+', default=list(MODULES))
+    parser.add_argument('--repeat', type=int, default=5, help='Imports per module; the fastest counts')
+    parser.add_argument('--budget-ms', type=float, default=100.0, help='Maximum import time per module')
+    parser.add_argument('--json', help='Write the results to this file')
+    args = parser.parse_args()
+
+    results = {}
+    failures = []
+    for module in args.modules:
+        measurements = [measure(module) for _ in range(args.repeat)]
+        seconds = min(seconds for seconds, _ in measurements)
+        heavy = measurements[0][1]
+        results[module] = {'seconds': seconds, 'heavy_modules': heavy}
+        print(f'{module:40} {seconds * 1000:7.1f} ms' + (f'  loads {", ".join(heavy)}' if heavy else ''))
+
+        if seconds * 1000 > args.budget_ms:
+            failures.append(f'{module} took {seconds * 1000:.1f} ms (budget {args.budget_ms:.0f} ms)')
+        if heavy:
+            failures.append(f'{module} imports {", ".join(heavy)} at startup')
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
+
+    for failure in failures:
+        print(f'REGRESSION {failure}')
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+Perceptual hashing costs: dHash and pHash per image, near-duplicate lookups against a HashIndex of --entries
+hashes (vectorized XOR/popcount over the memory-mapped array, against a Python loop over the same hashes), reopening
+the index, and picking a diverse subset for the stitcher.
+
+Run from the repository root: python -m benchmarks.bench_phash
+"""
+import argparse
+import os
+import tempfile
+from time import perf_counter
+
+import numpy as np
+from PIL import Image, ImageFilter
+
+from src.phash import HashIndex, PerceptualHash
+
+
+def _time(function, repeat) -> float:
+    t0 = perf_counter()
+    for _ in range(repeat):
+        function()
+    return (perf_counter() - t0) / repeat
+
+
+def _python_loop_duplicates(hashes: list[int], image_hash, max_distance) -> list[int]:
+    return [i for i, other in enumerate(hashes) if bin(other ^ image_hash).count('1') <= max_distance]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--entries', type=int, default=100_000)
+    parser.add_argument('--lookups', type=int, default=200)
+    parser.add_argument('--max-distance', type=int, default=4)
+    parser.add_argument('--size', type=int, default=1024, help='Width and height of the hashed images')
+    parser.add_argument('--diverse-from', type=int, default=5000, help='Hashes to pick a diverse subset from')
+    parser.add_argument('--diverse-count', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    image = Image.fromarray(rng.integers(0, 256, (args.size, args.size, 3), dtype=np.uint8)).filter(
+        ImageFilter.GaussianBlur(32))
+    edited = image.resize((args.size // 2, args.size // 2)).convert('RGB')
+    for kind in ('dhash', 'phash'):
+        hash_image = getattr(PerceptualHash, kind)
+        seconds = _time(lambda: hash_image(image), 20)
+        distance = bin(hash_image(image) ^ hash_image(edited)).count('1')
+        print(f'{kind}: {seconds * 1000:.2f} ms per {args.size}x{args.size} image, '
+              f'{distance} bits from a half-size copy')
+
+    hashes = rng.integers(0, 2 ** 63, args.entries, dtype=np.uint64, endpoint=True)
+    queries = [int(image_hash) for image_hash in rng.integers(0, 2 ** 63, args.lookups, dtype=np.uint64)]
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'image_hashes')
+        index = HashIndex(path)
+        t0 = perf_counter()
+        for i, image_hash in enumerate(hashes):
+            index.add(int(image_hash), f'image_{i}.png')
+        add_seconds = perf_counter() - t0
+
+        queries = iter(queries)
+        lookup_seconds = _time(lambda: index.find_duplicates(next(queries), args.max_distance), args.lookups)
+        hash_list = [int(image_hash) for image_hash in hashes]
+        loop_seconds = _time(lambda: _python_loop_duplicates(hash_list, hash_list[0], args.max_distance), 3)
+        index.close()
+
+        t0 = perf_counter()
+        HashIndex(path).close()
+        open_seconds = perf_counter() - t0
+
+    print(f'index of {args.entries} hashes: {add_seconds / args.entries * 1e6:.1f} us per add, '
+          f'opened in {open_seconds * 1000:.1f} ms')
+    print(f'lookup: {lookup_seconds * 1000:.2f} ms vectorized, {loop_seconds * 1000:.1f} ms Python loop '
+          f'({loop_seconds / lookup_seconds:.0f}x)')
+
+    subset = hashes[:args.diverse_from]
+    seconds = _time(lambda: PerceptualHash.select_diverse(subset, args.diverse_count), 3)
+    print(f'select_diverse: {args.diverse_count} of {len(subset)} in {seconds * 1000:.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""
+Spreads a mixed-checkpoint workload over several mock Stable Diffusion backends and compares plain
+least-outstanding-requests scheduling with checkpoint affinity. In a final run one backend starts failing partway
+through, to show failover: the requests it fails are not retried, as a 5xx may come after generation, but later
+requests go to the other backends. Reports images/min, checkpoint reloads and per-backend stats.
+
+Run from the repository root: python -m benchmarks.bench_sd_dispatcher
+"""
+import argparse
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from time import perf_counter
+
+from benchmarks.mock_sd_server import MockStableDiffusion
+from benchmarks.stubserver import StubServer
+from src.sddispatcher import SDDispatcher
+from src.stablediffusionhandler import StableDiffusion
+
+NEGATIVE_PROMPT = 'bad art, unrealistic, ugly, low resolution'
+
+
+def _run(args, affinity, fail_after=None) -> dict:
+    checkpoints = [f'checkpoint_{i}.safetensors' for i in range(args.checkpoints)]
+    mocks = [MockStableDiffusion(args.size, args.size, args.seconds_per_image, args.load_seconds,
+                                 checkpoint=checkpoints[i % len(checkpoints)]) for i in range(args.backends)]
+    servers = [StubServer(respond=mock.respond).__enter__() for mock in mocks]
+
+    dispatcher = SDDispatcher([f'{server.url}sdapi/v1/' for server in servers], affinity=affinity,
+                              health_interval=0.5)
+    dispatcher.start()
+    StableDiffusion.dispatcher = dispatcher
+
+    rng = random.Random(args.seed)
+    workload = [rng.choice(checkpoints) for _ in range(args.requests)]
+    completed = [0]
+    lock = threading.Lock()
+
+    def render(checkpoint):
+        response = StableDiffusion.request_txt2img('neon city at night', NEGATIVE_PROMPT, model_checkpoint=checkpoint)
+        with lock:
+            completed[0] += 1
+            if completed[0] == fail_after:
+                servers[0].error_rate = 1.0  # Every request, health checks included, now gets a 503
+        return response
+
+    failures = 0
+    t0 = perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        for future in as_completed([executor.submit(render, checkpoint) for checkpoint in workload]):
+            if future.exception() is not None:
+                failures += 1
+    elapsed = perf_counter() - t0
+
+    dispatcher.close()
+    StableDiffusion.dispatcher = None
+    for server in servers:
+        server.__exit__(None, None, None)
+
+    return {
+        'images_per_minute': 60 * (args.requests - failures) / elapsed,
+        'checkpoint_loads': sum(mock.checkpoint_loads for mock in mocks),
+        'failures': failures,
+        'backends': dispatcher.stats(),
+    }
+
+
+def _print(name, result):
+    print(f'{name}: {result["images_per_minute"]:.1f} images/min, {result["checkpoint_loads"]} checkpoint loads, '
+          f'{result["failures"]} failed requests')
+    for url, stats in result['backends'].items():
+        print(f'  {url}: healthy={stats["healthy"]} completed={stats["completed"]} failed={stats["failed"]} '
+              f'switches={stats["checkpoint_switches"]} {stats["images_per_minute"]:.1f} images/min')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--backends', type=int, default=3)
+    parser.add_argument('--checkpoints', type=int, default=3)
+    parser.add_argument('--requests', type=int, default=36)
+    parser.add_argument('--concurrency', type=int, default=6, help='Requests in flight at once')
+    parser.add_argument('--seconds-per-image', type=float, default=0.2, help='Simulated GPU time per image')
+    parser.add_argument('--load-seconds', type=float, default=1.0, help='Simulated checkpoint reload time')
+    parser.add_argument('--size', type=int, default=256)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    _print('least outstanding', _run(args, affinity=False))
+    _print('checkpoint affinity', _run(args, affinity=True))
+    _print('affinity, backend 0 failing', _run(args, affinity=True, fail_after=args.requests // 3))
+
+
+if __name__ == '__main__':
+    main()
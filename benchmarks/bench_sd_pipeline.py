@@ -0,0 +1,77 @@
+"""
+Compares images/min for the sequential generation loop and ImagePipeline against the mock Stable Diffusion server.
+Both are timed until the background image writer has saved every image.
+
+Run from the repository root: python -m benchmarks.bench_sd_pipeline
+"""
+import argparse
+import contextlib
+import io
+import os
+import tempfile
+from time import sleep, time
+
+from benchmarks.mock_sd_server import MockStableDiffusion
+from benchmarks.stubserver import StubServer
+from src.imagepipeline import ImagePipeline
+from src.imagewriter import image_writer
+from src.stablediffusionhandler import StableDiffusion
+
+NEGATIVE_PROMPT = 'bad art, unrealistic, ugly, low resolution'
+
+
+def _run_sequential(next_prompt, num_images) -> float:
+    t0 = time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(num_images):
+            image = StableDiffusion.txt2img(next_prompt(), NEGATIVE_PROMPT)
+            image.save('sequential')
+        image_writer.flush()
+    return 60 * num_images / (time() - t0)
+
+
+def _run_pipelined(next_prompt, num_images, batch_size) -> float:
+    t0 = time()
+    pipeline = ImagePipeline(next_prompt,
+                             render=lambda prompt: StableDiffusion.request_txt2img(prompt, NEGATIVE_PROMPT,
+                                                                                   batch_size=batch_size),
+                             on_image=lambda image: image.save('pipelined'),
+                             decode_workers=2)
+    num_prompts = num_images // batch_size
+    pipeline.run(num_prompts=num_prompts)
+    image_writer.flush()
+    return 60 * num_prompts * batch_size / (time() - t0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--images', type=int, default=16)
+    parser.add_argument('--batch-size', type=int, default=2)
+    parser.add_argument('--seconds-per-image', type=float, default=0.5, help='Simulated GPU time per image')
+    parser.add_argument('--prompt-latency', type=float, default=1.0, help='Simulated GPT time per prompt')
+    parser.add_argument('--size', type=int, default=1024)
+    args = parser.parse_args()
+
+    def next_prompt():
+        sleep(args.prompt_latency)
+        return 'neon city at night, rain, synthwave'
+
+    mock = MockStableDiffusion(args.size, args.size, args.seconds_per_image)
+    original_cwd = os.getcwd()
+    with StubServer(respond=mock.respond) as server, tempfile.TemporaryDirectory() as output_dir:
+        StableDiffusion.BASE_URL = f'{server.url}sdapi/v1/'
+        os.makedirs(os.path.join(output_dir, 'cwd'))
+        os.chdir(os.path.join(output_dir, 'cwd'))  # SDImage.save writes to ../images
+
+        try:
+            sequential = _run_sequential(next_prompt, args.images)
+            pipelined = _run_pipelined(next_prompt, args.images, args.batch_size)
+        finally:
+            os.chdir(original_cwd)
+
+    print(f'sequential: {sequential:.1f} images/min')
+    print(f' pipelined: {pipelined:.1f} images/min (batch size {args.batch_size})')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""
+Retained memory for a 10k-track playlist held as raw API dicts, as Track records and as a TrackTable, plus the peak
+memory of parsing the JSON document whole or (if ijson is installed) incrementally.
+
+Run from the repository root: python -m benchmarks.bench_track_memory
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import string
+import tempfile
+import tracemalloc
+
+from src.lazyimport import LazyModule
+from src.models import Track, TrackTable
+
+ijson = LazyModule.optional('ijson')
+
+MARKETS = ['AD', 'AE', 'AG', 'AL', 'AM', 'AO', 'AR', 'AT', 'AU', 'AZ', 'BA', 'BB', 'BD', 'BE', 'BF', 'BG', 'BH', 'BI',
+           'BJ', 'BN', 'BO', 'BR', 'BS', 'BT', 'BW', 'BY', 'BZ', 'CA', 'CD', 'CG', 'CH', 'CI', 'CL', 'CM', 'CO', 'CR',
+           'CV', 'CW', 'CY', 'CZ', 'DE', 'DJ', 'DK', 'DM', 'DO', 'DZ', 'EC', 'EE', 'EG', 'ES', 'ET', 'FI', 'FJ', 'FM',
+           'FR', 'GA', 'GB', 'GD', 'GE', 'GH', 'GM', 'GN', 'GQ', 'GR', 'GT', 'GW', 'GY', 'HK', 'HN', 'HR', 'HT', 'HU',
+           'ID', 'IE', 'IL', 'IN', 'IQ', 'IS', 'IT', 'JM', 'JO', 'JP', 'KE', 'KG', 'KH', 'KI', 'KM', 'KN', 'KR', 'KW']
+
+
+def _spotify_id(rng) -> str:
+    return ''.join(rng.choices(string.ascii_letters + string.digits, k=22))
+
+
+def make_playlist_items(num_tracks, num_albums=1500, num_artists=800, seed=0) -> list[dict]:
+    """
+    Playlist track items shaped like the Web API's, including the fields the scripts never read
+    """
+    rng = random.Random(seed)
+    artists = [{'id': _spotify_id(rng), 'name': f'Artist {i}', 'type': 'artist',
+                'external_urls': {'spotify': 'https://open.spotify.com/artist/x'}} for i in range(num_artists)]
+    albums = []
+    for i in range(num_albums):
+        album_id = _spotify_id(rng)
+        albums.append({
+            'id': album_id, 'name': f'Album {i}', 'album_type': 'album', 'available_markets': MARKETS,
+            'artists': rng.sample(artists, 1), 'release_date': '2020-01-01', 'total_tracks': 12,
+            'external_urls': {'spotify': f'https://open.spotify.com/album/{album_id}'},
+            'images': [{'url': f'https://i.scdn.co/image/{album_id}{size}', 'width': size, 'height': size}
+                       for size in (640, 300, 64)],
+        })
+
+    items = []
+    for i in range(num_tracks):
+        track_id = _spotify_id(rng)
+        album = rng.choice(albums)
+        items.append({
+            'added_at': '2023-01-01T00:00:00Z', 'is_local': False,
+            'track': {
+                'id': track_id, 'name': f'Track {i}', 'album': album, 'artists': album['artists'],
+                'available_markets': MARKETS, 'duration_ms': 200000, 'explicit': False, 'popularity': 50,
+                'external_ids': {'isrc': 'USRC00000000'}, 'preview_url': None, 'track_number': 1,
+                'external_urls': {'spotify': f'https://open.spotify.com/track/{track_id}'},
+            },
+        })
+    return items
+
+
+def _retained(build) -> int:
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return current
+
+
+def _peak(build) -> int:
+    gc.collect()
+    tracemalloc.start()
+    build()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--tracks', type=int, default=10_000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        fixture = os.path.join(directory, 'playlist.json')
+        with open(fixture, 'w') as file:
+            json.dump({'items': make_playlist_items(args.tracks), 'total': args.tracks}, file)
+
+        def load_items():
+            with open(fixture) as file:
+                return json.load(file)['items']
+
+        results = [
+            ('raw dicts (retained)', _retained(lambda: [item['track'] for item in load_items()])),
+            ('Track records (retained)',
+             _retained(lambda: [Track.from_api_response(item['track']) for item in load_items()])),
+            ('TrackTable (retained)', _retained(lambda: TrackTable.from_api_response(load_items()))),
+            ('json.load parse (peak)', _peak(lambda: TrackTable.from_api_response(load_items()))),
+        ]
+        if ijson is not None:
+            def stream_items():
+                table = TrackTable()
+                with open(fixture, 'rb') as file:
+                    for item in ijson.items(file, 'items.item'):  # The document is never held whole
+                        if item.get('track'):
+                            table.append(Track.from_api_response(item['track']))
+                return table
+            results.append(('ijson stream parse (peak)', _peak(stream_items)))
+
+    for name, size in results:
+        print(f'{name:>26}: {size / 2 ** 20:7.1f} MiB ({args.tracks} tracks)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,320 @@
+"""
+Local stand-ins for the Spotify Web API, the lyrics API and OpenAI chat completions. FakeServices runs them, with
+MockStableDiffusion, on local ports and points the clients at them, so the scripts can run offline.
+"""
+import io
+import json
+import random
+import threading
+import zlib
+from string import ascii_uppercase
+from time import sleep, time
+from urllib.parse import parse_qs, urlsplit
+
+import openai
+from PIL import Image
+
+from benchmarks.mock_sd_server import MockStableDiffusion
+from benchmarks.stubserver import StubServer
+from src.spotifyhandler import Spotify
+from src.stablediffusionhandler import StableDiffusion
+
+GENRES = ['indie pop', 'dream pop', 'shoegaze', 'synthwave', 'chillwave', 'deep house', 'techno', 'uk garage',
+          'drum and bass', 'neo soul', 'jazz fusion', 'bossa nova', 'alt rock', 'post-punk', 'emo', 'folk',
+          'bedroom pop', 'hip hop', 'lo-fi beats', 'ambient', 'modern classical', 'k-pop', 'afrobeats', 'metalcore']
+WORDS = ['neon', 'city', 'rain', 'midnight', 'ocean', 'glass', 'summer', 'ghost', 'velvet', 'static', 'gold',
+         'horizon', 'echo', 'wild', 'paper', 'moon', 'fire', 'silver', 'dream', 'river', 'signal', 'electric', 'blue',
+         'garden', 'shadow', 'light', 'heart', 'road', 'wave', 'storm', 'cherry', 'sky', 'dust', 'coast', 'bloom']
+
+
+def _seed(*parts) -> int:
+    """
+    Seed that is stable across processes, unlike hash()
+    """
+    return zlib.crc32('/'.join(map(str, parts)).encode('utf-8'))
+
+
+def _words(rng: random.Random, count) -> str:
+    return ' '.join(rng.choice(WORDS) for _ in range(count))
+
+
+class FakeSpotify:
+    """
+    The Spotify Web API routes the scripts use, over a generated library. Every user has the same playlists.
+    markets: length of each album's and track's available_markets, which makes up most of a real response
+    art_size: width of the largest album art image
+    """
+
+    def __init__(self, num_playlists=20, tracks_per_playlist=200, num_albums=300, num_artists=150, album_tracks=12,
+                 markets=80, art_size=640, base_url='http://127.0.0.1/'):
+        self.num_playlists = num_playlists
+        self.tracks_per_playlist = tracks_per_playlist
+        self.num_albums = num_albums
+        self.num_artists = num_artists
+        self.album_tracks = album_tracks
+        self.markets = [a + b for a in ascii_uppercase for b in ascii_uppercase][:markets]
+        self.art_size = art_size
+        self.base_url = base_url
+
+        self._versions = [0] * num_playlists
+        self._art: dict[int, bytes] = {}
+        self._lock = threading.Lock()
+
+    def change_playlists(self, fraction, seed=0):
+        """
+        Gives a fraction of the playlists new tracks and a new snapshot_id
+        """
+        rng = random.Random(seed)
+        for i in rng.sample(range(self.num_playlists), round(fraction * self.num_playlists)):
+            self._versions[i] += 1
+
+    @classmethod
+    def route(cls, path) -> str:
+        segments = urlsplit(path).path.strip('/').split('/')
+        if segments[0] != 'v1':
+            return segments[0] if segments[0] != 'api' else 'token'
+        return '/'.join('{id}' if i % 2 else segment for i, segment in enumerate(segments[1:]))
+
+    def respond(self, method, path, request_body) -> tuple:
+        url = urlsplit(path)
+        params = {name: values[0] for name, values in parse_qs(url.query).items()}
+        segments = url.path.strip('/').split('/')
+
+        if segments == ['api', 'token']:
+            return 200, {'access_token': 'fake-token', 'token_type': 'Bearer', 'expires_in': 3600}
+        if segments[0] == 'images':
+            return 200, self._album_art(int(params.get('size', self.art_size))), {'Content-Type': 'image/jpeg'}
+        if segments[0] != 'v1':
+            return 404, {'error': {'status': 404, 'message': 'Not found'}}
+
+        offset, limit = int(params.get('offset', 0)), int(params.get('limit', 20))
+        match segments[1:]:
+            case ['users', user_id, 'playlists']:
+                playlists = [self._playlist(i, user_id) for i in range(self.num_playlists)]
+                return 200, self._page(playlists[offset:offset + limit], offset, limit, len(playlists))
+            case ['playlists', playlist_id]:
+                return 200, self._playlist(self._index(playlist_id))
+            case ['playlists', playlist_id, 'tracks']:
+                track_numbers = self._playlist_tracks(self._index(playlist_id))
+                items = [{'added_at': '2023-01-01T00:00:00Z', 'is_local': False, 'track': self._track(number)}
+                         for number in track_numbers[offset:offset + limit]]
+                return 200, self._page(items, offset, limit, len(track_numbers))
+            case ['albums']:
+                return 200, {'albums': [self._album(self._index(album_id)) for album_id in params['ids'].split(',')]}
+            case ['albums', album_id]:
+                return 200, self._album(self._index(album_id))
+            case ['albums', album_id, 'tracks']:
+                tracks = self._album_track_items(self._index(album_id))
+                return 200, self._page(tracks[offset:offset + limit], offset, limit, len(tracks))
+            case ['artists']:
+                return 200, {'artists': [self._artist(self._index(artist_id))
+                                         for artist_id in params['ids'].split(',')]}
+            case ['search']:
+                album = self._simple_album(_seed(params.get('q')) % self.num_albums)
+                return 200, {'albums': self._page([album], 0, limit, 1)}
+        return 404, {'error': {'status': 404, 'message': 'Not found'}}
+
+    @classmethod
+    def _index(cls, object_id) -> int:
+        return int(object_id[2:])
+
+    @classmethod
+    def _page(cls, items, offset, limit, total) -> dict:
+        return {'items': items, 'offset': offset, 'limit': limit, 'total': total,
+                'next': None if offset + limit >= total else 'next'}
+
+    def _playlist(self, i, owner='fake') -> dict:
+        return {
+            'id': f'pl{i:05d}', 'name': f'Playlist {i}', 'snapshot_id': f'snapshot-{i}-{self._versions[i]}',
+            'description': '', 'owner': {'id': owner}, 'public': True,
+            'tracks': {'total': len(self._playlist_tracks(i))},
+        }
+
+    def _playlist_tracks(self, i) -> list[int]:
+        num_tracks = self.num_albums * self.album_tracks
+        rng = random.Random(_seed('playlist', i, self._versions[i]))
+        return rng.sample(range(num_tracks), min(self.tracks_per_playlist, num_tracks))
+
+    def _track(self, number, with_album=True) -> dict:
+        track = {
+            'id': f'tr{number:06d}', 'name': _words(random.Random(_seed('track', number)), 2).title(),
+            'artists': [self._simple_artist(number // self.album_tracks % self.num_artists)],
+            'available_markets': self.markets, 'duration_ms': 200000, 'explicit': False,
+            'track_number': number % self.album_tracks + 1, 'type': 'track',
+        }
+        if with_album:
+            track['album'] = self._simple_album(number // self.album_tracks)
+        return track
+
+    def _album_track_items(self, n) -> list[dict]:
+        return [self._track(n * self.album_tracks + k, with_album=False) for k in range(self.album_tracks)]
+
+    def _simple_album(self, n) -> dict:
+        album_id = f'al{n:05d}'
+        return {
+            'id': album_id, 'name': f'Album {n}', 'album_type': 'album', 'href': f'{self.base_url}v1/albums/{album_id}',
+            'artists': [self._simple_artist(n % self.num_artists)], 'available_markets': self.markets,
+            'release_date': '2020-01-01', 'total_tracks': self.album_tracks,
+            'images': [{'url': f'{self.base_url}images/{album_id}?size={size}', 'width': size, 'height': size}
+                       for size in (self.art_size, 300, 64)],
+        }
+
+    def _album(self, n) -> dict:
+        items = self._album_track_items(n)
+        return {**self._simple_album(n), 'genres': [], 'tracks': self._page(items[:50], 0, 50, len(items))}
+
+    def _simple_artist(self, n) -> dict:
+        return {'id': f'ar{n:05d}', 'name': f'Artist {n}', 'type': 'artist'}
+
+    def _artist(self, n) -> dict:
+        rng = random.Random(_seed('artist', n))
+        return {**self._simple_artist(n), 'genres': rng.sample(GENRES, rng.randint(1, 3)), 'popularity': 50}
+
+    def _album_art(self, size) -> bytes:
+        with self._lock:
+            if size not in self._art:
+                image = Image.effect_noise((size, size), 64).convert('RGB')
+                buffer = io.BytesIO()
+                image.save(buffer, format='JPEG', quality=90)
+                self._art[size] = buffer.getvalue()
+            return self._art[size]
+
+
+class FakeLyrics:
+    """
+    The lyrics API. A fixed fraction of tracks, chosen by track id, have no lyrics.
+    """
+
+    def __init__(self, lines=40, no_lyrics_rate=0.2):
+        self.lines = lines
+        self.no_lyrics_rate = no_lyrics_rate
+
+    @classmethod
+    def route(cls, path) -> str:
+        return 'lyrics'
+
+    def respond(self, method, path, request_body) -> tuple:
+        track_id = parse_qs(urlsplit(path).query).get('trackid', [''])[0]
+        rng = random.Random(_seed('lyrics', track_id))
+        if rng.random() < self.no_lyrics_rate:
+            return 404, {'error': True, 'message': 'lyrics for this track is not available on spotify!'}
+
+        lines = [{'startTimeMs': str(i * 3000), 'words': _words(rng, 6), 'syllables': [], 'endTimeMs': '0'}
+                 for i in range(self.lines)]
+        return 200, {'error': False, 'syncType': 'LINE_SYNCED', 'lines': lines}
+
+
+class FakeOpenAI:
+    """
+    OpenAI chat completions, streamed or not, with n choices. Streams send one token per choice every
+    token_latency seconds.
+    """
+
+    def __init__(self, completion_words=60, token_latency=0.005, seed=0):
+        self.completion_words = completion_words
+        self.token_latency = token_latency
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def route(cls, path) -> str:
+        return urlsplit(path).path.strip('/').removeprefix('v1/')
+
+    def respond(self, method, path, request_body) -> tuple:
+        if self.route(path) != 'chat/completions':
+            return 404, {'error': {'message': 'Not found', 'type': 'invalid_request_error'}}
+
+        request = json.loads(request_body)
+        n = request.get('n', 1)
+        with self._lock:
+            completions = [_words(self._random, self.completion_words) for _ in range(n)]
+
+        if request.get('stream'):
+            return 200, self._stream(request['model'], completions), {'Content-Type': 'text/event-stream'}
+
+        prompt_tokens = len(request_body) // 4
+        completion_tokens = sum(len(completion.split()) for completion in completions)
+        return 200, {
+            'id': 'chatcmpl-fake', 'object': 'chat.completion', 'created': int(time()), 'model': request['model'],
+            'choices': [{'index': i, 'message': {'role': 'assistant', 'content': completion},
+                         'finish_reason': 'stop'} for i, completion in enumerate(completions)],
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                      'total_tokens': prompt_tokens + completion_tokens},
+        }
+
+    def _stream(self, model, completions):
+        def event(deltas: list[tuple[int, dict, str or None]]) -> bytes:
+            chunk = {'id': 'chatcmpl-fake', 'object': 'chat.completion.chunk', 'created': int(time()), 'model': model,
+                     'choices': [{'index': i, 'delta': delta, 'finish_reason': finish_reason}
+                                 for i, delta, finish_reason in deltas]}
+            return b'data: ' + json.dumps(chunk).encode('utf-8') + b'\n\n'
+
+        yield event([(i, {'role': 'assistant'}, None) for i in range(len(completions))])
+        tokens = [completion.split(' ') for completion in completions]
+        for position in range(max(map(len, tokens))):
+            sleep(self.token_latency)
+            yield event([(i, {'content': (' ' if position else '') + words[position]}, None)
+                         for i, words in enumerate(tokens) if position < len(words)])
+        yield event([(i, {}, 'stop') for i in range(len(completions))])
+        yield b'data: [DONE]\n\n'
+
+
+class FakeServices:
+    """
+    Runs the fake Spotify, lyrics, OpenAI and Stable Diffusion servers, and points Spotify, openai and
+    StableDiffusion at them while in use.
+
+    latencies, error_rates: per service name, see StubServer. Stable Diffusion's generation time is set on
+    MockStableDiffusion instead.
+    """
+    DEFAULT_LATENCIES = {'spotify': 0.05, 'lyrics': 0.1, 'openai': 0.3, 'stable_diffusion': 0.0}
+
+    def __init__(self, spotify: FakeSpotify = None, lyrics: FakeLyrics = None, chat: FakeOpenAI = None,
+                 stable_diffusion: MockStableDiffusion = None, latencies: dict[str, float] = None,
+                 error_rates: dict[str, float] = None, jitter=0.5, seed=0):
+        self.fakes = {
+            'spotify': spotify or FakeSpotify(),
+            'lyrics': lyrics or FakeLyrics(),
+            'openai': chat or FakeOpenAI(seed=seed),
+            'stable_diffusion': stable_diffusion or MockStableDiffusion(512, 512, 0.2, variants=1024),
+        }
+        latencies = {**self.DEFAULT_LATENCIES, **(latencies or {})}
+        error_rates = error_rates or {}
+        self.servers = {name: StubServer(respond=fake.respond, latency=latencies[name], jitter=jitter,
+                                         error_rate=error_rates.get(name, 0.0), seed=_seed(seed, name))
+                        for name, fake in self.fakes.items()}
+        self.fakes['spotify'].base_url = self.servers['spotify'].url
+
+        self._saved_settings = None
+
+    def __enter__(self):
+        for server in self.servers.values():
+            server.__enter__()
+
+        self._saved_settings = (Spotify.base_url, Spotify.token_url, Spotify.lyrics_url, openai.api_base,
+                                openai.api_key, StableDiffusion.BASE_URL)
+        Spotify.base_url = self.servers['spotify'].url + 'v1/'
+        Spotify.token_url = self.servers['spotify'].url + 'api/token'
+        Spotify.lyrics_url = self.servers['lyrics'].url
+        openai.api_base = self.servers['openai'].url + 'v1'
+        openai.api_key = 'sk-fake'
+        StableDiffusion.BASE_URL = self.servers['stable_diffusion'].url + 'sdapi/v1/'
+        return self
+
+    def __exit__(self, *exc_info):
+        (Spotify.base_url, Spotify.token_url, Spotify.lyrics_url, openai.api_base, openai.api_key,
+         StableDiffusion.BASE_URL) = self._saved_settings
+        for server in self.servers.values():
+            server.__exit__(*exc_info)
+
+    def service_for(self, url) -> tuple[str, str] or None:
+        """
+        The (service name, route) a request URL is for, or None if it is not for one of the fakes
+        """
+        parts = urlsplit(url)
+        for name, server in self.servers.items():
+            if urlsplit(server.url).netloc == parts.netloc:
+                path = parts.path + ('?' + parts.query if parts.query else '')
+                return name, self.fakes[name].route(path)
+        return None
@@ -0,0 +1,99 @@
+"""
+Stand-in for the AUTOMATIC1111 webui /sdapi/v1 routes. Returns one of `variants` noise images, in turn, per
+generated image after a configurable per-image delay, one request at a time as on a single GPU. Requests for a
+checkpoint other than the loaded one first wait checkpoint_load_seconds, as the webui does while it swaps weights.
+
+Run from the repository root: python -m benchmarks.mock_sd_server --port 7860
+"""
+import argparse
+import base64
+import io
+import json
+import os
+import threading
+from time import sleep
+
+from PIL import Image
+
+from benchmarks.stubserver import StubServer
+
+
+class MockStableDiffusion:
+    def __init__(self, width=1024, height=1024, seconds_per_image=0.5, checkpoint_load_seconds=0.0, checkpoint=None,
+                 variants=1):
+        self.width = width
+        self.height = height
+        self.seconds_per_image = seconds_per_image
+        self.checkpoint_load_seconds = checkpoint_load_seconds
+        self.checkpoint = checkpoint
+        self.variants = variants
+        self.images_generated = 0
+        self.checkpoint_loads = 0
+
+        self._images_base64 = [self._make_image(width, height)]  # The rest are made when first needed
+        self._gpu = threading.Lock()
+
+    @classmethod
+    def _make_image(cls, width, height) -> str:
+        image = Image.frombytes('RGB', (width, height), os.urandom(width * height * 3))
+        buffer = io.BytesIO()
+        image.save(buffer, format='PNG', compress_level=1)
+        return base64.b64encode(buffer.getvalue()).decode('ascii')
+
+    @classmethod
+    def route(cls, path) -> str:
+        return path.split('?')[0].rstrip('/').rsplit('/', 1)[-1]
+
+    def respond(self, method, path, request_body) -> tuple[int, dict]:
+        route = self.route(path)
+        if route == 'png-info':
+            return 200, {'info': 'mock parameters'}
+        if route == 'options':
+            return 200, {'sd_model_checkpoint': f'{self.checkpoint} [0123456789]' if self.checkpoint else None}
+        if route not in ('txt2img', 'img2img'):
+            return 404, {'detail': 'Not Found'}
+
+        payload = json.loads(request_body)
+        num_images = payload.get('batch_size', 1) * payload.get('n_iter', 1)
+        with self._gpu:
+            checkpoint = payload.get('sd_model_checkpoint')
+            if checkpoint and checkpoint != self.checkpoint:
+                sleep(self.checkpoint_load_seconds)
+                self.checkpoint = checkpoint
+                self.checkpoint_loads += 1
+            sleep(self.seconds_per_image * num_images)
+            images = [self._image(self.images_generated + i) for i in range(num_images)]
+            self.images_generated += num_images
+
+        infotexts = [f'{payload["prompt"]}\nSteps: {payload.get("steps")}, Seed: {i}' for i in range(num_images)]
+        if num_images > 1:
+            images.insert(0, images[0])  # Grid image
+            infotexts.insert(0, infotexts[0])
+
+        return 200, {'images': images, 'parameters': payload, 'info': json.dumps({'infotexts': infotexts})}
+
+    def _image(self, i) -> str:
+        i %= self.variants
+        while len(self._images_base64) <= i:
+            self._images_base64.append(self._make_image(self.width, self.height))
+        return self._images_base64[i]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--port', type=int, default=7860)
+    parser.add_argument('--seconds-per-image', type=float, default=0.5)
+    parser.add_argument('--size', type=int, default=1024)
+    parser.add_argument('--checkpoint-load-seconds', type=float, default=0.0)
+    parser.add_argument('--variants', type=int, default=1, help='Number of different images to return in turn')
+    args = parser.parse_args()
+
+    mock = MockStableDiffusion(args.size, args.size, args.seconds_per_image, args.checkpoint_load_seconds,
+                               variants=args.variants)
+    with StubServer(respond=mock.respond, port=args.port) as server:
+        print(f'Mock Stable Diffusion listening on {server.url}sdapi/v1/')
+        server.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+import json
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep
+
+
+class StubServer:
+    """
+    Minimal local HTTP server for benchmarks. Every request gets the same JSON body after an optional delay, unless
+    respond(method, path, request_body) is given, in which case it returns (status, content) or
+    (status, content, headers). content is sent as JSON, as is if it is bytes, or with chunked encoding if it is an
+    iterator of bytes.
+
+    latency: delay before each response, varied by up to +-jitter (a fraction of latency)
+    error_rate: fraction of requests answered with 503 and `Retry-After: 0` instead
+    """
+
+    def __init__(self, body=None, latency=0.0, respond=None, port=0, jitter=0.0, error_rate=0.0, seed=None):
+        self.body = json.dumps(body if body is not None else {'ok': True}).encode('utf-8')
+        self.latency = latency
+        self.respond = respond
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.request_count = 0
+        self.connection_count = 0
+        self.error_count = 0
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address
+        return f'http://{host}:{port}/'
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def wait(self):
+        self._thread.join()
+
+    def _make_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                with stub._lock:
+                    stub.connection_count += 1
+
+            def do_GET(self):
+                self._respond(b'')
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                self._respond(self.rfile.read(length))
+
+            def _respond(self, request_body):
+                with stub._lock:
+                    stub.request_count += 1
+                    delay = stub.latency * (1 + stub._random.uniform(-stub.jitter, stub.jitter))
+                    fail = stub._random.random() < stub.error_rate
+                    if fail:
+                        stub.error_count += 1
+                if delay > 0:
+                    sleep(delay)
+
+                status, content, headers = 200, stub.body, {}
+                if fail:
+                    status, content, headers = 503, {'error': 'injected'}, {'Retry-After': '0'}
+                elif stub.respond is not None:
+                    status, content, *extra = stub.respond(self.command, self.path, request_body)
+                    headers = extra[0] if extra else {}
+
+                self.send_response(status)
+                self.send_header('Content-Type', headers.pop('Content-Type', 'application/json'))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+
+                if isinstance(content, (dict, list)):
+                    content = json.dumps(content).encode('utf-8')
+                if isinstance(content, bytes):
+                    self.send_header('Content-Length', str(len(content)))
+                    self.end_headers()
+                    self.wfile.write(content)
+                    return
+
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                for chunk in content:
+                    self.wfile.write(f'{len(chunk):x}\r\n'.encode('ascii') + chunk + b'\r\n')
+                    self.wfile.flush()
+                self.wfile.write(b'0\r\n\r\n')
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,311 @@
+"""
+Generates art for many playlists without any interactive prompts.
+
+Playlists are processed as a pipeline: metadata fetch, genre estimation, prompt generation and Stable Diffusion
+rendering each have their own worker pool, so different playlists can be at different stages at once. Progress is
+checkpointed to a job file after every stage. Re-running with the same job file resumes where it stopped.
+
+Playlists are listed fresh on every run. A finished playlist is only redone if its snapshot_id has changed, and its
+tracks are only refetched from Spotify if they changed since they were last stored in the playlist store.
+
+Example: python batch_generate_playlist_art.py --user 1245938457 --playlist-file playlists.txt
+"""
+import argparse
+import json
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from random import shuffle
+from statistics import median
+from time import perf_counter, time
+
+from src.cache import CompletionCache, LRUStore, ResponseCache
+from src.genreestimator import GenreEstimator
+from src.imagewriter import image_writer
+from src.instrumentation import instrumentation
+from src.openaihandler import OpenAI
+from src.phash import HashIndex
+from src.playlistsync import PlaylistSync
+from src.sddispatcher import SDDispatcher
+from src.spotifyhandler import spotify
+from src.stablediffusionhandler import StableDiffusion
+from src.userinterface import UserInterface
+
+STAGES = ('metadata', 'genre', 'prompt', 'render')
+NEGATIVE_PROMPT = 'bad art, unrealistic, ugly, low resolution'
+
+
+class BatchJob:
+    """
+    State of every playlist in the batch, saved to a JSON file whenever it changes
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.playlists: dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+        if os.path.exists(path):
+            with open(path) as file:
+                self.playlists = json.load(file)['playlists']
+
+    def add(self, playlist_id, name=None, snapshot_id=None):
+        with self._lock:
+            playlist = self.playlists.get(playlist_id)
+            if playlist is None or (snapshot_id is not None and playlist.get('snapshot_id') != snapshot_id):
+                # New, or modified since its art was generated
+                playlist = self.playlists[playlist_id] = {
+                    'name': name or playlist_id,
+                    'snapshot_id': snapshot_id,
+                    'status': 'pending',
+                    'genre': None,
+                    'prompts': [],
+                    'images': [],
+                    'rendered': 0,  # Prompts rendered; near-duplicate images are not kept, so may exceed images
+                    'timings': {},
+                    'error': None,
+                }
+            if playlist['status'] == 'failed':
+                playlist.update(status='pending', error=None)  # Retry failures from earlier runs
+            self._save()
+
+    def update(self, playlist_id, timings: dict[str, float] = None, **fields):
+        with self._lock:
+            playlist = self.playlists[playlist_id]
+            playlist.update(fields)
+            playlist['timings'].update(timings or {})
+            self._save()
+
+    def pending(self) -> list[str]:
+        return [playlist_id for playlist_id, playlist in self.playlists.items() if playlist['status'] != 'done']
+
+    def _save(self):
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump({'playlists': self.playlists}, file, indent=2)
+        os.replace(temp_path, self.path)
+
+
+class BatchRunner:
+    def __init__(self, job: BatchJob, sync: PlaylistSync, genre_estimator: GenreEstimator, workers: dict[str, int],
+                 images_per_playlist=1, default_genre='eclectic'):
+        self.job = job
+        self.sync = sync
+        self.genre_estimator = genre_estimator
+        self.images_per_playlist = images_per_playlist
+        self.default_genre = default_genre
+
+        self._executors = {stage: ThreadPoolExecutor(workers[stage], thread_name_prefix=stage) for stage in STAGES}
+        self._remaining = 0
+        self._lock = threading.Lock()
+        self._finished = threading.Event()
+
+    def add_users(self, user_ids):
+        listings = [self._executors['metadata'].submit(self.sync.get_playlists, user_id) for user_id in user_ids]
+        for listing in listings:
+            for playlist in listing.result():
+                self.job.add(playlist['id'], playlist['name'], playlist['snapshot_id'])
+
+    def add_playlists(self, playlist_ids):
+        playlists = [self._executors['metadata'].submit(self.sync.get_playlist, playlist_id)
+                     for playlist_id in playlist_ids]
+        for playlist in playlists:
+            playlist = playlist.result()
+            self.job.add(playlist['id'], playlist['name'], playlist['snapshot_id'])
+
+    def run(self) -> float:
+        playlist_ids = self.job.pending()
+        self._remaining = len(playlist_ids)
+        if not playlist_ids:
+            return 0.0
+
+        t0 = perf_counter()
+        for playlist_id in playlist_ids:
+            # Prompts are checkpointed, so a playlist that has them only needs rendering
+            first_stage = 'render' if self.job.playlists[playlist_id]['prompts'] else 'metadata'
+            self._submit(first_stage, playlist_id, {})
+
+        while not self._finished.wait(timeout=0.5):
+            pass
+        return perf_counter() - t0
+
+    def shutdown(self):
+        for executor in self._executors.values():
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _submit(self, stage, playlist_id, context: dict):
+        self._executors[stage].submit(self._run_stage, stage, playlist_id, context)
+
+    def _run_stage(self, stage, playlist_id, context: dict):
+        # Runs on an executor, which would swallow any exception, so every path must end the playlist or pass it on
+        playlist = self.job.playlists[playlist_id]
+        try:
+            t0 = perf_counter()
+            with instrumentation.span(f'batch.{stage}', playlist=playlist_id):
+                fields = getattr(self, f'_{stage}')(playlist_id, playlist, context)
+            elapsed = perf_counter() - t0
+            self.job.update(playlist_id, timings={stage: elapsed}, status=stage, **fields)
+            print(f'[{stage}] {playlist["name"]} ({elapsed:.2f}s)')
+
+            if stage == STAGES[-1]:
+                self.job.update(playlist_id, status='done')
+                self._finish_playlist()
+            else:
+                self._submit(STAGES[STAGES.index(stage) + 1], playlist_id, context)
+        except Exception as e:
+            print(f'[{stage}] {playlist["name"]} failed: {e!r}')
+            try:
+                self.job.update(playlist_id, status='failed', error=f'{stage}: {e!r}')
+            finally:
+                self._finish_playlist()
+
+    def _metadata(self, playlist_id, playlist, context) -> dict:
+        context['tracks'] = self.sync.get_tracks(playlist_id, playlist.get('snapshot_id'))
+        return {'num_tracks': len(context['tracks'])}
+
+    def _genre(self, playlist_id, playlist, context) -> dict:
+        if playlist['genre'] is not None:
+            return {}
+        genre = self.genre_estimator.estimate(context['tracks'], playlist_id, playlist.get('snapshot_id'))
+        genre = genre or self.default_genre
+        return {'genre': genre}
+
+    def _prompt(self, playlist_id, playlist, context) -> dict:
+        track_names = list(context['tracks'].names)
+        shuffle(track_names)
+        prompts = OpenAI.get_txt2img_playlist_prompts(playlist['genre'], track_names, self.images_per_playlist)
+        return {'prompts': prompts}
+
+    def _render(self, playlist_id, playlist, context) -> dict:
+        file_name = re.sub(r'\W', '', playlist['name']) + '_' + playlist_id
+        images = list(playlist['images'])
+        rendered = playlist.get('rendered', len(images))  # Job files from before 'rendered' was kept
+        for prompt in playlist['prompts'][rendered:]:
+            response = StableDiffusion.request_txt2img(prompt, NEGATIVE_PROMPT)
+            for image in StableDiffusion.extract_images(response):
+                path = image.save(file_name).result()
+                if path is not None:  # None if it was a near-duplicate of an image already saved
+                    images.append(path)
+            rendered += 1
+            self.job.update(playlist_id, images=images, rendered=rendered)  # Checkpoint after every prompt
+        return {'images': images, 'rendered': rendered}
+
+    def _finish_playlist(self):
+        with self._lock:
+            self._remaining -= 1
+            if self._remaining == 0:
+                self._finished.set()
+
+
+def build_report(job: BatchJob, wall_time) -> dict:
+    stage_timings = {stage: [playlist['timings'][stage] for playlist in job.playlists.values()
+                             if stage in playlist['timings']] for stage in STAGES}
+    statuses = [playlist['status'] for playlist in job.playlists.values()]
+    return {
+        'generated_at': time(),
+        'wall_time': wall_time,
+        'playlists': {status: statuses.count(status) for status in sorted(set(statuses))},
+        'images': sum(len(playlist['images']) for playlist in job.playlists.values()),
+        'stages': {
+            stage: {
+                'count': len(timings),
+                'total': sum(timings),
+                'mean': sum(timings) / len(timings) if timings else 0.0,
+                'median': median(timings) if timings else 0.0,
+                'max': max(timings, default=0.0),
+            } for stage, timings in stage_timings.items()
+        },
+        'failures': {playlist_id: playlist['error'] for playlist_id, playlist in job.playlists.items()
+                     if playlist['status'] == 'failed'},
+    }
+
+
+def _read_ids(path) -> list[str]:
+    with open(path) as file:
+        return [UserInterface.parse_spotify_id(line.strip()) for line in file if line.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--user', nargs='*', default=[], help='Spotify user IDs or profile links')
+    parser.add_argument('--playlist', nargs='*', default=[], help='Spotify playlist IDs or links')
+    parser.add_argument('--user-file', help='File with one user ID or link per line')
+    parser.add_argument('--playlist-file', help='File with one playlist ID or link per line')
+    parser.add_argument('--job-file', default='../batch_job.json')
+    parser.add_argument('--report', default='../batch_report.json')
+    parser.add_argument('--playlist-store', default='../cache/playlists.sqlite',
+                        help='Where tracks and genres are kept between runs to detect unchanged playlists')
+    parser.add_argument('--sd-backends', nargs='+', metavar='URL',
+                        help='Stable Diffusion API roots to spread rendering over, e.g. http://gpu1:7860/sdapi/v1/. '
+                             'Use at least as many render workers as backends.')
+    parser.add_argument('--trace', help='Append a JSON-lines trace of every request and stage to this file')
+    parser.add_argument('--metrics', help='Write counters and span durations here in the Prometheus text format')
+    parser.add_argument('--max-hash-distance', type=int, default=4,
+                        help='Skip images whose perceptual hash is within this many bits of an image already saved; '
+                             '-1 to keep every image')
+    parser.add_argument('--images-per-playlist', type=int, default=1)
+    parser.add_argument('--dominant-genre-share', type=float, default=0.6,
+                        help='Use a genre or supergenre covering this share of tracks without asking GPT; '
+                             'above 1 to always ask')
+    parser.add_argument('--default-genre', default='eclectic', help='Used when no genres are found for a playlist')
+    for stage, workers in zip(STAGES, (8, 4, 4, 1)):
+        parser.add_argument(f'--{stage}-workers', type=int, default=workers)
+    args = parser.parse_args()
+
+    user_ids = [UserInterface.parse_spotify_id(user_id) for user_id in args.user]
+    playlist_ids = [UserInterface.parse_spotify_id(playlist_id) for playlist_id in args.playlist]
+    if args.user_file:
+        user_ids += _read_ids(args.user_file)
+    if args.playlist_file:
+        playlist_ids += _read_ids(args.playlist_file)
+
+    if args.trace or args.metrics:
+        instrumentation.enable(args.trace)
+
+    dispatcher = None
+    if args.sd_backends:
+        dispatcher = StableDiffusion.dispatcher = SDDispatcher(args.sd_backends)
+        dispatcher.start()
+
+    spotify.cache = ResponseCache('../cache/spotify.sqlite')
+    OpenAI.completion_cache = CompletionCache('../cache/openai.sqlite')
+    image_writer.hash_index = HashIndex('../cache/image_hashes')
+    image_writer.max_hash_distance = args.max_hash_distance
+
+    playlist_store = LRUStore(args.playlist_store, max_bytes=256 * 1024 * 1024)
+    sync = PlaylistSync(playlist_store, spotify)
+    genre_estimator = GenreEstimator(playlist_store, spotify, min_dominant_share=args.dominant_genre_share)
+
+    job = BatchJob(args.job_file)
+    workers = {stage: getattr(args, f'{stage}_workers') for stage in STAGES}
+    runner = BatchRunner(job, sync, genre_estimator, workers, args.images_per_playlist, args.default_genre)
+
+    wall_time = 0.0
+    try:
+        runner.add_playlists(playlist_ids)
+        runner.add_users(user_ids)
+        wall_time = runner.run()
+    except KeyboardInterrupt:
+        print(f'\nInterrupted. Progress is saved in {args.job_file}; run again to resume.')
+    finally:
+        runner.shutdown()
+
+    report = build_report(job, wall_time)
+    report['playlist_store'] = sync.stats()
+    report['genres'] = genre_estimator.stats()
+    report['duplicate_images'] = image_writer.duplicates
+    if dispatcher is not None:
+        dispatcher.close()
+        report['sd_backends'] = dispatcher.stats()
+    if instrumentation.enabled:
+        report['counters'] = instrumentation.counters()
+    if args.metrics:
+        instrumentation.write_prometheus(args.metrics)
+    with open(args.report, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f'\nDone: {report["playlists"]}, {report["images"]} images in {wall_time:.1f}s. Report: {args.report}')
+
+
+if __name__ == '__main__':
+    main()
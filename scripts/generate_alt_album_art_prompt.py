@@ -1,6 +1,10 @@
-from concurrent.futures import ThreadPoolExecutor
-
+from src.cache import CompletionCache, LRUStore, ResponseCache
+from src.imagepipeline import ImagePipeline
+from src.imagewriter import image_writer
+from src.lyricsservice import LyricsService
 from src.openaihandler import OpenAI
+from src.phash import HashIndex
+from src.promptqueue import PromptQueue
 from src.spotifyhandler import spotify, SpotifyAlbum
 from src.stablediffusionhandler import StableDiffusion
 from src.userinterface import UserInterface
@@ -21,42 +25,40 @@ def _get_album() -> SpotifyAlbum:
 def _get_lyric_summaries(album: SpotifyAlbum) -> dict[str, str or None]:
     print('Getting lyric summaries... ', end='')
 
-    def _make_request(track):
-        track_lyrics = spotify.get_lyrics(track['id'])
-        lyric_summary = OpenAI.summarise_song_lyrics(track_lyrics) if track_lyrics else None
-        return lyric_summary
-
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        lyric_summaries = executor.map(_make_request, album.tracks)
+    lyrics_service = LyricsService(spotify, cache=LRUStore('../cache/lyrics.sqlite'))
+    lyrics = lyrics_service.get_summaries(album.tracks)
 
-    num_songs_with_lyrics = len([lyric_summary for lyric_summary in lyric_summaries])
+    num_songs_with_lyrics = len([lyric_summary for lyric_summary in lyrics.values() if lyric_summary])
 
     print(f'Found lyrics for {num_songs_with_lyrics}/{len(album.tracks)} songs.')
     if num_songs_with_lyrics == 0:
         raise ValueError('No lyrics found for any track')
 
-    track_names = [track['name'] for track in album.tracks]
-    lyrics = dict(zip(track_names, lyric_summaries))
     return lyrics
 
 
 def _run_generation_loop(album: SpotifyAlbum, lyrics: dict[str, str or None], denoising):
-    thread_pool = ThreadPoolExecutor(max_workers=1)
-    prompt_future = thread_pool.submit(OpenAI.get_img2img_album_prompt, lyrics)
+    prompt_queue = PromptQueue(lambda n: OpenAI.get_img2img_album_prompts(lyrics, n, stream=True), batch_size=4)
 
-    while True:
-        sd_prompt = prompt_future.result()
-        UserInterface.display_prompt(sd_prompt)
-        prompt_future = thread_pool.submit(OpenAI.get_img2img_album_prompt, lyrics)
+    def render(sd_prompt):
+        return StableDiffusion.request_img2img(album.album_art, sd_prompt,
+                                               negative_prompt='bad art, unrealistic, low resolution',
+                                               denoising_strength=denoising)
 
-        image = StableDiffusion.img2img(album.album_art, sd_prompt,
-                                        negative_prompt='bad art, unrealistic, low resolution',
-                                        denoising_strength=denoising)
+    def show_and_save(image):
         image.show()
         image.save(album.name)
 
+    pipeline = ImagePipeline(lambda: UserInterface.display_prompt_stream(prompt_queue.get()), render, show_and_save,
+                             queue_size=1)
+    pipeline.run()
+
 
 def main():
+    spotify.cache = ResponseCache('../cache/spotify.sqlite')
+    OpenAI.completion_cache = CompletionCache('../cache/openai.sqlite')
+    image_writer.hash_index = HashIndex('../cache/image_hashes')
+
     album = _get_album()
     lyrics = _get_lyric_summaries(album)
 
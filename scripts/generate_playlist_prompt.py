@@ -1,58 +1,45 @@
 import re
-from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from itertools import chain
-from random import shuffle, sample
+from random import shuffle
 
+from src.cache import CompletionCache, LRUStore, ResponseCache
+from src.genreestimator import GenreEstimator
+from src.imagewriter import image_writer
+from src.models import TrackTable
 from src.openaihandler import OpenAI
+from src.phash import HashIndex
+from src.promptqueue import PromptQueue
 from src.spotifyhandler import spotify
 from src.stablediffusionhandler import StableDiffusion
 from src.userinterface import UserInterface
 
 
-def _estimate_playlist_genre(all_tracks):
-    sample_size = 25
-    sample_tracks = sample(all_tracks, sample_size)
+def _estimate_playlist_genre(all_tracks: TrackTable, playlist: dict):
+    genre_estimator = GenreEstimator(LRUStore('../cache/playlists.sqlite', max_bytes=256 * 1024 * 1024), spotify)
+    playlist_genre = genre_estimator.estimate(all_tracks, playlist['id'], playlist.get('snapshot_id'))
 
-    def make_request(track) -> list:
-        album_id = track['album']['id']
-        if album_id is None:
-            return []
-        album = spotify._make_request(f'albums/{album_id}')
-        genres = album['genres']
-        return genres
-
-    with ThreadPoolExecutor(max_workers=sample_size) as executor:
-        results = list(executor.map(make_request, sample_tracks))
-
-    all_genres = list(chain(*results))
-
-    if not all_genres:
+    if playlist_genre is None:
         playlist_genre = input('Enter playlist genre: ')
     else:
-        playlist_genre = OpenAI.summarise_genre(all_genres)
         print(f'Estimated playlist genre: {playlist_genre}')
 
     return playlist_genre
 
 
-def _image_gen_loop(all_tracks, playlist_genre):
-    playlist_genre_filename = re.sub(r'\W', '', playlist_genre)
+def _image_gen_loop(all_tracks: TrackTable, playlist_genre):
+    playlist_genre_filename = re.sub(r'\W', '', playlist_genre)[:100]  # GPT may answer with more than a few terms
 
-    all_track_names = [track['name'] for track in all_tracks]
-    shuffle(all_track_names)
+    all_track_names = list(all_tracks.names)
+
+    def generate_prompts(n):
+        shuffle(all_track_names)  # Shuffle for different results
+        return OpenAI.get_txt2img_playlist_prompts(playlist_genre, all_track_names, n, stream=True)
 
-    thread_pool = ThreadPoolExecutor(max_workers=1)
-    prompt_future = thread_pool.submit(OpenAI.get_txt2img_playlist_prompt, playlist_genre, all_track_names[:50])
+    prompt_queue = PromptQueue(generate_prompts, batch_size=4)
 
     should_continue = True
     while should_continue:
-        track_names = all_track_names[:50]  # Limits to 50 song titles
-
-        stable_diffusion_prompt = prompt_future.result()
-        prompt_future = thread_pool.submit(OpenAI.get_txt2img_playlist_prompt, playlist_genre, track_names)
-
-        UserInterface.display_prompt(stable_diffusion_prompt)
+        stable_diffusion_prompt = UserInterface.display_prompt_stream(prompt_queue.get())
 
         image = StableDiffusion.txt2img(stable_diffusion_prompt,
                                         negative_prompt='bad art, unrealistic, ugly, low resolution')
@@ -62,17 +49,20 @@ def _image_gen_loop(all_tracks, playlist_genre):
         if not show_images:
             should_continue = UserInterface.should_continue()
 
-        shuffle(all_track_names)  # Shuffle for different results
-
 
 def main():
+    spotify.cache = ResponseCache('../cache/spotify.sqlite')
+    OpenAI.completion_cache = CompletionCache('../cache/openai.sqlite')
+    image_writer.hash_index = HashIndex('../cache/image_hashes')
+
     user_id = UserInterface.get_user_id()
     playlists = spotify.get_playlists(user_id)
 
     playlist_id = UserInterface.choose_playlist(playlists)
+    playlist = next(playlist for playlist in playlists if playlist['id'] == playlist_id)
 
     all_tracks = spotify.get_tracks(playlist_id)
-    playlist_genre = _estimate_playlist_genre(all_tracks)
+    playlist_genre = _estimate_playlist_genre(all_tracks, playlist)
 
     _image_gen_loop(all_tracks, playlist_genre)
 
@@ -1,50 +1,169 @@
 from PIL import Image
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import hashlib
 import os
 
+from src.phash import HashIndex, PerceptualHash
 
-def resize_images(directory):
-    files = [f for f in os.listdir(directory) if os.path.isfile(os.path.join(directory, f))]
-    img_files = [f for f in files if f.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp'))]
-    img_objs = []
-
-    for img_file in img_files:
-        with Image.open(os.path.join(directory, img_file)) as img:
-            img_objs.append(img.resize((512, 512)))
+TILE_SIZE = 512
 
-    return img_objs
 
-
-def stitch_images(images, columns=2, margin=10):
+def list_images(directory):
+    files = sorted(f for f in os.listdir(directory) if os.path.isfile(os.path.join(directory, f)))
+    img_files = [f for f in files if f.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp'))]
+    return [os.path.join(directory, img_file) for img_file in img_files]
+
+
+def make_thumbnail(path, size=TILE_SIZE, cache_dir=None):
+    """
+    Decodes an image and resizes it to size x size. JPEGs are decoded at a reduced scale with draft(), and other
+    formats are shrunk by an integer factor with reduce() before the final resize.
+    If cache_dir is given, thumbnails are cached there keyed on the file's path and modification time.
+    """
+    cache_path = _thumbnail_cache_path(path, size, cache_dir) if cache_dir else None
+    if cache_path and os.path.exists(cache_path):
+        with Image.open(cache_path) as thumbnail:
+            return thumbnail.convert('RGB')
+
+    with Image.open(path) as img:
+        img.draft('RGB', (size, size))
+        if img.mode != 'RGB':
+            img = img.convert('RGB')  # reduce() does not support palette, bilevel or 16-bit images
+        factor = min(img.width // size, img.height // size)
+        if factor > 1:
+            img = img.reduce(factor)
+        thumbnail = img.resize((size, size))
+
+    if cache_path:
+        temp_path = f'{cache_path}.{os.getpid()}.tmp'
+        thumbnail.save(temp_path, 'JPEG', quality=90)
+        os.replace(temp_path, cache_path)
+    return thumbnail
+
+
+def _thumbnail_cache_path(path, size, cache_dir):
+    stat = os.stat(path)
+    key = f'{os.path.abspath(path)}:{stat.st_mtime_ns}:{stat.st_size}:{size}'
+    return os.path.join(cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.jpg')
+
+
+def _load_tile(index, path, size, cache_dir):
+    # Runs in a worker process; raw pixels are cheaper to send back than a pickled image
+    return index, make_thumbnail(path, size, cache_dir).tobytes()
+
+
+def _hash_image(path, size, cache_dir):
+    # Hashing the thumbnail rather than the full image is much cheaper and it is reused when stitching
+    return PerceptualHash.dhash(make_thumbnail(path, size, cache_dir))
+
+
+def select_diverse_images(executor, image_paths, max_images=None, max_hash_distance=-1, size=TILE_SIZE,
+                          cache_dir=None, hash_index: HashIndex = None):
+    """
+    Returns up to max_images of image_paths, in their original order, chosen to look as different from each other
+    as possible, leaving out images within max_hash_distance bits of one already chosen. Hashes are read from
+    hash_index where it has them and computed from thumbnails otherwise.
+    """
+    hashes = [hash_index.get(path) if hash_index is not None and hash_index.kind == 'dhash' else None
+              for path in image_paths]
+    missing = [i for i, image_hash in enumerate(hashes) if image_hash is None]
+    computed = executor.map(_hash_image, [image_paths[i] for i in missing], [size] * len(missing),
+                            [cache_dir] * len(missing), chunksize=16)
+    for i, image_hash in zip(missing, computed):
+        hashes[i] = image_hash
+
+    selected = PerceptualHash.select_diverse(hashes, max_images, max_hash_distance)
+    return [image_paths[i] for i in selected]
+
+
+def iter_thumbnails(executor, image_paths, size=TILE_SIZE, cache_dir=None, max_in_flight=16):
+    """
+    Yields (index, thumbnail) as each image finishes decoding, which may be out of order.
+    At most max_in_flight thumbnails are being decoded or waiting to be pasted at once.
+    """
+    paths = iter(enumerate(image_paths))
+    in_flight = set()
+    while True:
+        for index, path in paths:
+            in_flight.add(executor.submit(_load_tile, index, path, size, cache_dir))
+            if len(in_flight) >= max_in_flight:
+                break
+
+        if not in_flight:
+            return
+
+        done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            index, pixels = future.result()
+            yield index, Image.frombytes('RGB', (size, size), pixels)
+
+
+def stitch_images(executor, image_paths, columns=2, margin=10, size=TILE_SIZE, cache_dir=None):
     if columns < 1:
         raise ValueError("Number of columns must be at least 1")
 
-    num_images = len(images)
+    num_images = len(image_paths)
 
     # Calculate canvas size
-    canvas_width = columns * 512 + (columns + 1) * margin
+    canvas_width = columns * size + (columns + 1) * margin
     rows = (num_images + columns - 1) // columns
-    canvas_height = rows * 512 + (rows + 1) * margin
+    canvas_height = rows * size + (rows + 1) * margin
 
     # Create a blank white canvas
     canvas = Image.new('RGB', (canvas_width, canvas_height), 'white')
 
-    y_offset = margin
-    for i, img in enumerate(images):
-        x_offset = margin + (i % columns) * (512 + margin)
+    # Paste each tile as soon as it has been decoded
+    for i, img in iter_thumbnails(executor, image_paths, size, cache_dir):
+        x_offset = margin + (i % columns) * (size + margin)
+        y_offset = margin + (i // columns) * (size + margin)
         canvas.paste(img, (x_offset, y_offset))
-        if (i + 1) % columns == 0:
-            y_offset += 512 + margin
 
     return canvas
 
 
+def stitch_pages(executor, image_paths, columns=2, margin=10, size=TILE_SIZE, cache_dir=None,
+                 max_canvas_bytes=256 * 2 ** 20):
+    """
+    Yields canvases of as many full rows as fit in max_canvas_bytes of RGB pixels, so memory use stays fixed
+    however many images there are.
+    """
+    canvas_width = columns * size + (columns + 1) * margin
+    row_bytes = canvas_width * (size + margin) * 3
+    rows_per_page = max(1, (max_canvas_bytes - canvas_width * margin * 3) // row_bytes)
+    images_per_page = rows_per_page * columns
+
+    for start in range(0, len(image_paths), images_per_page):
+        yield stitch_images(executor, image_paths[start:start + images_per_page], columns, margin, size, cache_dir)
+
+
 def main():
     directory = '../images'
     columns = 2  # Adjust the number of columns as needed
-    images = resize_images(directory)
-    result = stitch_images(images, columns)
-
-    result.save('stitched_image.jpg', 'JPEG')
+    max_canvas_bytes = None  # Set e.g. to 256 * 2 ** 20 to split the output into pages that fit in this much memory
+    cache_dir = os.path.join(directory, '.thumbnails')  # Set to None to disable the thumbnail cache
+    max_images = None  # Set to only include this many images, picked to look as different as possible
+    max_hash_distance = None  # Set e.g. to 6 to leave out images that look almost the same as one already included
+    hash_index_path = '../cache/image_hashes'  # Hashes recorded when the images were saved
+
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+    image_paths = list_images(directory)
+
+    with ProcessPoolExecutor() as executor:
+        if max_images is not None or max_hash_distance is not None:
+            hash_index = HashIndex(hash_index_path) if os.path.exists(f'{hash_index_path}.paths') else None
+            image_paths = select_diverse_images(executor, image_paths, max_images,
+                                                -1 if max_hash_distance is None else max_hash_distance,
+                                                cache_dir=cache_dir, hash_index=hash_index)
+
+        if max_canvas_bytes is None:
+            result = stitch_images(executor, image_paths, columns, cache_dir=cache_dir)
+            result.save('stitched_image.jpg', 'JPEG')
+        else:
+            pages = stitch_pages(executor, image_paths, columns, cache_dir=cache_dir,
+                                 max_canvas_bytes=max_canvas_bytes)
+            for page, result in enumerate(pages, start=1):
+                result.save(f'stitched_image_{page:03}.jpg', 'JPEG')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,204 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+from time import time
+from urllib.parse import urlsplit
+
+
+class CacheEntry:
+    __slots__ = ('value', 'etag', 'expires_at')
+
+    def __init__(self, value, etag=None, expires_at=None):
+        self.value = value
+        self.etag = etag
+        self.expires_at = expires_at
+
+    @property
+    def is_fresh(self) -> bool:
+        return self.expires_at is None or time() < self.expires_at
+
+
+class LRUStore:
+    """
+    Single-file SQLite key/value store capped at max_bytes. Least recently used entries are evicted first.
+    Values are stored as JSON. Safe to share between threads.
+    """
+
+    def __init__(self, path, max_bytes=64 * 1024 * 1024):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.max_bytes = max_bytes
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS entries ('
+                         'key TEXT PRIMARY KEY, value TEXT NOT NULL, etag TEXT, expires_at REAL,'
+                         'accessed_at REAL NOT NULL, size INTEGER NOT NULL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at)')
+
+    def get(self, key) -> CacheEntry or None:
+        with self._lock:
+            row = self._db.execute('SELECT value, etag, expires_at FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            self._db.execute('UPDATE entries SET accessed_at = ? WHERE key = ?', (time(), key))
+
+        value, etag, expires_at = row
+        return CacheEntry(json.loads(value), etag, expires_at)
+
+    def put(self, key, value, expires_at=None, etag=None):
+        value = json.dumps(value, separators=(',', ':'))
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)',
+                             (key, value, etag, expires_at, time(), len(value)))
+            self._evict()
+
+    def touch(self, key, expires_at=None):
+        with self._lock:
+            self._db.execute('UPDATE entries SET expires_at = ?, accessed_at = ? WHERE key = ?',
+                             (expires_at, time(), key))
+
+    def delete(self, key):
+        with self._lock:
+            self._db.execute('DELETE FROM entries WHERE key = ?', (key,))
+
+    @property
+    def size(self) -> int:
+        with self._lock:
+            return self._total_size()
+
+    def close(self):
+        self._db.close()
+
+    def _total_size(self) -> int:
+        return self._db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+    def _evict(self):
+        excess = self._total_size() - self.max_bytes
+        if excess <= 0:
+            return
+
+        evicted_keys = []
+        for key, size in self._db.execute('SELECT key, size FROM entries ORDER BY accessed_at'):
+            evicted_keys.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+
+        self._db.executemany('DELETE FROM entries WHERE key = ?', evicted_keys)
+        self.evictions += len(evicted_keys)
+
+
+class ResponseCache:
+    """
+    Cache for Spotify API responses keyed on URL and query parameters. Each route has its own TTL; expired entries
+    with an ETag are revalidated using If-None-Match rather than refetched.
+    """
+    HOUR = 60 * 60
+    DAY = 24 * HOUR
+
+    DEFAULT_TTLS = [
+        (r'/albums(/|$)', 30 * DAY),
+        (r'/artists(/|$)', 7 * DAY),
+        (r'/search$', DAY),
+        (r'/playlists/[^/]+/tracks$', HOUR),
+        (r'/users/[^/]+/playlists$', HOUR),
+    ]
+
+    def __init__(self, path, max_bytes=64 * 1024 * 1024, ttls: list[tuple[str, float]] = None, default_ttl=HOUR):
+        self._store = LRUStore(path, max_bytes)
+        self._ttls = [(re.compile(pattern), ttl) for pattern, ttl in (ttls or self.DEFAULT_TTLS)]
+        self.default_ttl = default_ttl
+
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+
+    @classmethod
+    def key(cls, url, params=None) -> str:
+        return url + '?' + json.dumps(params or {}, sort_keys=True)
+
+    def ttl_for(self, url) -> float:
+        path = urlsplit(url).path
+        for pattern, ttl in self._ttls:
+            if pattern.search(path):
+                return ttl
+        return self.default_ttl
+
+    def get(self, url, params=None) -> CacheEntry or None:
+        """
+        Returns the cached entry, which may be stale. Call served() if it is used without a request.
+        """
+        return self._store.get(self.key(url, params))
+
+    def served(self):
+        """
+        Counts a hit: a response served from the cache without any request
+        """
+        with self._lock:
+            self.hits += 1
+
+    def put(self, url, params, value, etag=None):
+        with self._lock:
+            self.misses += 1
+        self._store.put(self.key(url, params), value, expires_at=time() + self.ttl_for(url), etag=etag)
+
+    def revalidated(self, url, params=None):
+        with self._lock:
+            self.revalidations += 1
+        self._store.touch(self.key(url, params), expires_at=time() + self.ttl_for(url))
+
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'revalidations': self.revalidations,
+            'misses': self.misses,
+            'evictions': self._store.evictions,
+            'bytes': self._store.size,
+        }
+
+
+class CompletionCache:
+    """
+    Memoises chat completions under a hash of the model, messages and request arguments.
+    """
+
+    def __init__(self, path, max_bytes=16 * 1024 * 1024):
+        self._store = LRUStore(path, max_bytes)
+
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def key(cls, model, messages: list[dict], **kwargs) -> str:
+        request = json.dumps({'model': model, 'messages': messages, **kwargs}, sort_keys=True)
+        return hashlib.sha256(request.encode('utf-8')).hexdigest()
+
+    def get(self, key) -> str or None:
+        entry = self._store.get(key)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return entry.value
+
+    def put(self, key, completion: str):
+        self._store.put(key, completion)
+
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self._store.evictions,
+            'bytes': self._store.size,
+        }
@@ -0,0 +1,81 @@
+import threading
+from itertools import chain
+
+from src.cache import LRUStore
+from src.genreprofile import GenreProfile
+from src.models import TrackTable
+from src.openaihandler import OpenAI
+from src.spotifyhandler import Spotify, spotify
+
+
+class GenreEstimator:
+    """
+    Estimates a playlist's genre from a weighted GenreProfile of its tracks. If one genre, or one supergenre,
+    clearly dominates, that is the answer; otherwise only the top_k genres and their shares are summarised with GPT.
+    With a store, profiles and genres are kept per playlist snapshot_id, so an unchanged playlist costs no requests.
+
+    min_dominant_share: fraction of the tagged tracks a genre or supergenre needs for GPT to be skipped
+    """
+
+    def __init__(self, store: LRUStore = None, client: Spotify = None, top_k=15, min_dominant_share=0.6):
+        self.store = store
+        self.top_k = top_k
+        self.min_dominant_share = min_dominant_share
+        self._client = client or spotify
+
+        self._lock = threading.Lock()
+        self.cached = 0
+        self.dominant = 0
+        self.summarised = 0
+
+    @classmethod
+    def key(cls, playlist_id) -> str:
+        return f'genre:{playlist_id}'
+
+    def profile(self, tracks: TrackTable) -> GenreProfile:
+        albums = self._client.get_albums(tracks.album_ids)
+        artists = self._client.get_artists(chain.from_iterable(tracks.artist_ids))
+        return GenreProfile.from_tracks(tracks, albums, artists)
+
+    def estimate(self, tracks: TrackTable, playlist_id=None, snapshot_id=None) -> str or None:
+        """
+        Returns None if none of the playlist's tracks have a genre.
+        playlist_id, snapshot_id: to reuse the stored genre while the playlist is unchanged
+        """
+        cacheable = self.store is not None and playlist_id is not None and snapshot_id is not None
+        if cacheable:
+            entry = self.store.get(self.key(playlist_id))
+            if entry is not None and entry.value['snapshot_id'] == snapshot_id:
+                self._count('cached')
+                return entry.value['genre']
+
+        profile = self.profile(tracks)
+        genre = self.estimate_from_profile(profile)
+
+        if cacheable:
+            self.store.put(self.key(playlist_id),
+                           {'snapshot_id': snapshot_id, 'genre': genre, 'profile': profile.to_dict()})
+        return genre
+
+    def estimate_from_profile(self, profile: GenreProfile) -> str or None:
+        if not profile.tagged_tracks:
+            return None
+
+        genre = profile.dominant(self.min_dominant_share)
+        if genre is not None:
+            self._count('dominant')
+            return genre
+
+        self._count('summarised')
+        return OpenAI.summarise_genre(profile.top(self.top_k))
+
+    def stats(self) -> dict:
+        return {
+            'cached': self.cached,
+            'dominant': self.dominant,
+            'summarised': self.summarised,
+        }
+
+    def _count(self, outcome):
+        with self._lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
@@ -0,0 +1,151 @@
+from functools import lru_cache
+
+from src.models import Album, Artist, TrackTable
+
+# Spotify's genres are specific ('uk hip hop', 'melodic death metal'), so each is mapped to a broad supergenre by
+# the last of its words found here: the head of the name, e.g. 'pop punk' is punk and 'punk blues' is blues. Longer
+# keys are tried first, so 'western swing' is country although 'swing' is jazz.
+SUPERGENRES = {
+    'hip hop': 'hip hop', 'rap': 'hip hop', 'trap': 'hip hop', 'drill': 'hip hop', 'grime': 'hip hop',
+    'boom bap': 'hip hop',
+    'pop': 'pop', 'k-pop': 'pop', 'j-pop': 'pop', 'electropop': 'pop', 'synthpop': 'pop', 'hyperpop': 'pop',
+    'europop': 'pop', 'boy band': 'pop', 'girl group': 'pop',
+    'rock': 'rock', 'grunge': 'rock', 'shoegaze': 'rock', 'britpop': 'rock', 'post-rock': 'rock', 'emo': 'rock',
+    'garage rock': 'rock', 'psychedelic': 'rock', 'alternative': 'rock', 'indie': 'rock',
+    'punk': 'punk', 'hardcore': 'punk', 'post-punk': 'punk', 'ska': 'punk',
+    'metal': 'metal', 'metalcore': 'metal', 'deathcore': 'metal', 'djent': 'metal', 'doom': 'metal',
+    'thrash': 'metal', 'grindcore': 'metal',
+    'house': 'electronic', 'techno': 'electronic', 'trance': 'electronic', 'edm': 'electronic',
+    'electronic': 'electronic', 'electronica': 'electronic', 'electro': 'electronic', 'dubstep': 'electronic',
+    'drum and bass': 'electronic', 'dnb': 'electronic', 'jungle': 'electronic', 'breakbeat': 'electronic',
+    'idm': 'electronic', 'synthwave': 'electronic', 'big room': 'electronic', 'hardstyle': 'electronic',
+    'uk garage': 'electronic', 'speed garage': 'electronic', 'future garage': 'electronic',
+    'ambient': 'ambient', 'drone': 'ambient', 'new age': 'ambient', 'lo-fi': 'lo-fi', 'chillhop': 'lo-fi',
+    'r&b': 'r&b', 'soul': 'r&b', 'neo soul': 'r&b', 'motown': 'r&b', 'funk': 'funk', 'disco': 'funk',
+    'jazz': 'jazz', 'bebop': 'jazz', 'swing': 'jazz', 'big band': 'jazz', 'bossa nova': 'jazz',
+    'blues': 'blues',
+    'country': 'country', 'bluegrass': 'country', 'americana': 'country', 'honky tonk': 'country',
+    'western swing': 'country',
+    'folk': 'folk', 'singer-songwriter': 'folk', 'celtic': 'folk', 'acoustic': 'folk',
+    'classical': 'classical', 'orchestra': 'classical', 'baroque': 'classical', 'opera': 'classical',
+    'romantic era': 'classical', 'choral': 'classical', 'compositional ambient': 'classical',
+    'soundtrack': 'soundtrack', 'score': 'soundtrack', 'video game music': 'soundtrack', 'show tunes': 'soundtrack',
+    'latin': 'latin', 'reggaeton': 'latin', 'salsa': 'latin', 'bachata': 'latin', 'cumbia': 'latin',
+    'urbano latino': 'latin', 'mariachi': 'latin', 'flamenco': 'latin', 'samba': 'latin',
+    'reggae': 'reggae', 'dancehall': 'reggae', 'dub': 'reggae',
+    'afrobeats': 'african', 'afrobeat': 'african', 'afropop': 'african', 'amapiano': 'african',
+    'gospel': 'gospel', 'worship': 'gospel', 'ccm': 'gospel',
+}
+_MAX_KEY_WORDS = max(len(key.split()) for key in SUPERGENRES)
+
+
+class GenreProfile:
+    """
+    Weighted genre histogram of a playlist. Each track has a total weight of 1, split equally between its album, if
+    the album has genres, and each of its artists that has genres. A genre's weight is the sum over tracks of the
+    fraction of the track's sources tagged with it, so it counts tracks rather than tags: an artist with ten niche
+    genres does not outweigh one with two, and a track by three artists is not counted three times.
+    """
+
+    def __init__(self, genre_weights: dict[str, float], supergenre_weights: dict[str, float], num_tracks,
+                 tagged_tracks):
+        self.genre_weights = genre_weights
+        self.supergenre_weights = supergenre_weights
+        self.num_tracks = num_tracks
+        self.tagged_tracks = tagged_tracks
+
+    @classmethod
+    def from_tracks(cls, tracks: TrackTable, albums: list[Album], artists: list[Artist]) -> 'GenreProfile':
+        album_genres = {album.id: album.genres for album in albums if album.genres}
+        artist_genres = {artist.id: artist.genres for artist in artists if artist.genres}
+
+        genre_weights: dict[str, float] = {}
+        supergenre_weights: dict[str, float] = {}
+        tagged_tracks = 0
+        for album_id, artist_ids in zip(tracks.album_ids, tracks.artist_ids):
+            sources = [artist_genres[artist_id] for artist_id in artist_ids if artist_id in artist_genres]
+            if album_id in album_genres:
+                sources.append(album_genres[album_id])
+            if not sources:
+                continue
+
+            tagged_tracks += 1
+            source_weight = 1 / len(sources)
+            track_genres: dict[str, float] = {}
+            track_supergenres: dict[str, float] = {}
+            for genres in sources:
+                for genre in set(genres):
+                    track_genres[genre] = track_genres.get(genre, 0.0) + source_weight
+                for supergenre in {cls.supergenre(genre) for genre in genres}:
+                    track_supergenres[supergenre] = track_supergenres.get(supergenre, 0.0) + source_weight
+
+            for genre, weight in track_genres.items():
+                genre_weights[genre] = genre_weights.get(genre, 0.0) + weight
+            for supergenre, weight in track_supergenres.items():
+                supergenre_weights[supergenre] = supergenre_weights.get(supergenre, 0.0) + weight
+
+        return cls(genre_weights, supergenre_weights, len(tracks), tagged_tracks)
+
+    @classmethod
+    @lru_cache(maxsize=8192)
+    def supergenre(cls, genre) -> str:
+        """
+        The broad genre that a Spotify genre belongs to, or 'other'
+        """
+        words = genre.lower().split()
+        for end in range(len(words), 0, -1):
+            for length in range(min(_MAX_KEY_WORDS, end), 0, -1):
+                supergenre = SUPERGENRES.get(' '.join(words[end - length:end]))
+                if supergenre is not None:
+                    return supergenre
+        return 'other'
+
+    def share(self, genre) -> float:
+        """
+        Weight of genre as a fraction of the tracks with any genre
+        """
+        return self.genre_weights.get(genre, 0.0) / self.tagged_tracks if self.tagged_tracks else 0.0
+
+    def top(self, k=None, supergenre=None) -> list[tuple[str, float]]:
+        """
+        The k heaviest genres, optionally only those in supergenre, with their shares, heaviest first
+        """
+        genres = [genre for genre in self.genre_weights if supergenre is None or self.supergenre(genre) == supergenre]
+        genres.sort(key=lambda genre: (-self.genre_weights[genre], genre))
+        return [(genre, self.share(genre)) for genre in genres[:k]]
+
+    def top_supergenres(self, k=None) -> list[tuple[str, float]]:
+        supergenres = sorted(self.supergenre_weights, key=lambda supergenre: (-self.supergenre_weights[supergenre],
+                                                                                supergenre))
+        return [(supergenre, self.supergenre_weights[supergenre] / self.tagged_tracks)
+                for supergenre in supergenres[:k]]
+
+    def dominant(self, min_share=0.6, max_terms=3) -> str or None:
+        """
+        A label for the playlist if its genres leave no doubt, otherwise None: the heaviest genre if it has at least
+        min_share, or else the heaviest genres of a supergenre that has at least min_share
+        """
+        if not self.tagged_tracks:
+            return None
+
+        top_genre, top_share = self.top(1)[0]
+        if top_share >= min_share:
+            return top_genre
+
+        top_supergenre, supergenre_share = self.top_supergenres(1)[0]
+        if supergenre_share >= min_share and top_supergenre != 'other':
+            return ', '.join(genre for genre, _ in self.top(max_terms, top_supergenre))
+        return None
+
+    def to_dict(self) -> dict:
+        return {
+            'genre_weights': self.genre_weights,
+            'supergenre_weights': self.supergenre_weights,
+            'num_tracks': self.num_tracks,
+            'tagged_tracks': self.tagged_tracks,
+        }
+
+    @classmethod
+    def from_dict(cls, profile: dict) -> 'GenreProfile':
+        return cls(profile['genre_weights'], profile['supergenre_weights'], profile['num_tracks'],
+                   profile['tagged_tracks'])
@@ -0,0 +1,101 @@
+import threading
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from time import sleep
+from urllib.parse import urlsplit
+
+from src.instrumentation import instrumentation
+from src.lazyimport import LazyModule
+
+requests = LazyModule('requests')
+
+
+class HttpSession:
+    """
+    Thread-safe wrapper around a pooled requests.Session.
+
+    Connections are kept alive and reused per host, concurrent requests to a single host are capped, and
+    429/5xx responses (retry_statuses) are retried with exponential backoff, honouring any Retry-After header.
+    requests is only imported, and the session created, when the first request is made.
+    """
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, pool_size=32, max_per_host=16, max_retries=3, backoff=0.5, max_backoff=30, timeout=30,
+                 retry_statuses=RETRY_STATUSES):
+        self.pool_size = pool_size
+        self.max_per_host = max_per_host
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.retry_statuses = retry_statuses
+
+        self._session: 'requests.Session' = None
+        self._host_limits: dict[str, threading.BoundedSemaphore] = {}
+        self._lock = threading.Lock()
+
+    def get(self, url, **kwargs) -> 'requests.Response':
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs) -> 'requests.Response':
+        return self.request('POST', url, **kwargs)
+
+    def request(self, method, url, **kwargs) -> 'requests.Response':
+        kwargs.setdefault('timeout', self.timeout)
+        host_limit = self._host_limit(url)
+        session = self._session or self._create_session()
+
+        attempt = 0
+        while True:
+            with host_limit:
+                response = session.request(method, url, **kwargs)
+
+            if response.status_code not in self.retry_statuses or attempt >= self.max_retries:
+                return response
+
+            delay = self._retry_delay(response, attempt)
+            response.close()
+            instrumentation.count('http_retries_total', host=urlsplit(url).netloc, status=response.status_code)
+            instrumentation.count('http_retry_wait_seconds_total', delay, host=urlsplit(url).netloc)
+            sleep(delay)
+            attempt += 1
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+
+    def _create_session(self) -> 'requests.Session':
+        with self._lock:
+            if self._session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size,
+                                                        pool_block=True)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._session = session
+            return self._session
+
+    def _host_limit(self, url) -> threading.BoundedSemaphore:
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._host_limits:
+                self._host_limits[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self._host_limits[host]
+
+    def _retry_delay(self, response, attempt) -> float:
+        retry_after = response.headers.get('Retry-After')
+        if retry_after is not None:
+            try:
+                return min(max(float(retry_after), 0), self.max_backoff)
+            except ValueError:
+                pass
+            try:
+                retry_at = parsedate_to_datetime(retry_after)
+                wait = (retry_at - datetime.now(timezone.utc)).total_seconds()
+                return min(max(wait, 0), self.max_backoff)
+            except (TypeError, ValueError):
+                pass  # Unparseable or naive date, fall back to exponential backoff
+        return min(self.backoff * 2 ** attempt, self.max_backoff)
+
+
+http_session = HttpSession()
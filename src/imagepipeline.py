@@ -0,0 +1,133 @@
+import threading
+from queue import Queue
+from time import time
+from typing import Callable
+
+from src.stablediffusionhandler import SDImage, StableDiffusion
+
+_DONE = object()
+
+
+class ImagePipeline:
+    """
+    Generates images with prompt generation, Stable Diffusion requests, image decoding and saving running as
+    overlapping stages. Stages are connected by bounded queues, so a slow stage holds back the ones before it
+    instead of letting work pile up.
+
+    next_prompt: returns the next prompt
+    render: sends a prompt to Stable Diffusion and returns the raw API response, e.g. StableDiffusion.request_txt2img
+    on_image: called with each decoded image, e.g. to save it
+    """
+
+    def __init__(self, next_prompt: Callable[[], str], render: Callable[[str], dict],
+                 on_image: Callable[[SDImage], None], queue_size=2, render_workers=1, decode_workers=1):
+        self.next_prompt = next_prompt
+        self.render = render
+        self.on_image = on_image
+
+        self.queue_size = queue_size
+        self.render_workers = render_workers
+        self.decode_workers = decode_workers
+
+        self.num_images = 0
+        self.elapsed = 0.0
+
+        self._stop = threading.Event()
+        self._error: Exception = None
+        self._lock = threading.Lock()
+
+    @property
+    def images_per_minute(self) -> float:
+        return 60 * self.num_images / self.elapsed if self.elapsed else 0.0
+
+    def run(self, num_prompts: int = None):
+        """
+        Runs until num_prompts prompts have been rendered and saved, or forever if None.
+        On KeyboardInterrupt prompts still queued are skipped and no new ones are started; requests already in
+        flight are finished, decoded and saved before the interrupt is re-raised.
+        """
+        prompts, responses, images = Queue(self.queue_size), Queue(self.queue_size), Queue(self.queue_size)
+        threads = [threading.Thread(target=self._produce_prompts, args=(prompts, num_prompts), daemon=True)]
+        threads += self._start_stage(self.render, prompts, responses, self.render_workers, skip_on_stop=True)
+        threads += self._start_stage(StableDiffusion.extract_images, responses, images, self.decode_workers)
+        threads += self._start_stage(self._save, images, None, 1)
+        threads[0].start()
+
+        t0 = time()
+        try:
+            self._join(threads)
+        except KeyboardInterrupt:
+            self.stop()
+            self._join(threads)  # Queued prompts are skipped, so this only waits for work in flight
+            raise
+        finally:
+            self.elapsed = time() - t0
+
+        if self._error is not None:
+            raise self._error
+
+    def stop(self):
+        self._stop.set()
+
+    @classmethod
+    def _join(cls, threads: list[threading.Thread]):
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(timeout=0.5)  # Short timeouts so KeyboardInterrupt is not held up
+
+    def _produce_prompts(self, prompts: Queue, num_prompts):
+        count = 0
+        try:
+            while not self._stop.is_set() and (num_prompts is None or count < num_prompts):
+                prompts.put(self.next_prompt())
+                count += 1
+        except Exception as e:
+            self._fail(e)
+        finally:
+            prompts.put(_DONE)
+
+    def _start_stage(self, work, inbox: Queue, outbox: Queue or None, workers,
+                     skip_on_stop=False) -> list[threading.Thread]:
+        """
+        skip_on_stop: once stopped, drain the inbox without working, as after an error
+        """
+        remaining = [workers]
+
+        def run_worker():
+            while True:
+                item = inbox.get()
+                if item is _DONE:
+                    inbox.put(_DONE)  # Let the stage's other workers see it too
+                    break
+                if self._error is not None or (skip_on_stop and self._stop.is_set()):
+                    continue  # Drain without working so upstream stages are not blocked
+                try:
+                    result = work(item)
+                except Exception as e:
+                    self._fail(e)
+                    continue
+                if outbox is not None:
+                    outbox.put(result)
+
+            with self._lock:
+                remaining[0] -= 1
+                is_last = remaining[0] == 0
+            if is_last and outbox is not None:
+                outbox.put(_DONE)
+
+        threads = [threading.Thread(target=run_worker, daemon=True) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def _save(self, images: list[SDImage]):
+        for image in images:
+            self.on_image(image)
+            with self._lock:
+                self.num_images += 1
+
+    def _fail(self, error: Exception):
+        with self._lock:
+            if self._error is None:
+                self._error = error
+        self._stop.set()
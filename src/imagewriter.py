@@ -0,0 +1,169 @@
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from time import perf_counter
+
+from src.instrumentation import instrumentation
+from src.lazyimport import LazyModule
+from src.phash import HashIndex
+
+Image = LazyModule('PIL.Image')
+PngImagePlugin = LazyModule('PIL.PngImagePlugin')
+
+
+class ImageWriter:
+    """
+    Encodes and saves images on a pool of background threads. Each file is written to a temporary file in the
+    output directory and renamed into place, so readers never see a partial image. At most max_pending images are
+    queued; submit blocks beyond that.
+
+    image_format: 'png', 'webp' or 'jpeg'. Generation parameters are only kept in PNG text chunks.
+    compress_level: PNG zlib level, 0-9
+    quality, lossless: WebP/JPEG encoder settings
+    hash_index: if set, images within max_hash_distance bits of an image already saved, or being saved, are not
+    saved again. Hashes are only added to the index once their image has been written.
+    """
+    EXTENSIONS = {'png': 'png', 'webp': 'webp', 'jpeg': 'jpg'}
+
+    def __init__(self, output_root='../images', image_format='png', compress_level=6, quality=90, lossless=False,
+                 workers=2, max_pending=8, hash_index: HashIndex = None, max_hash_distance=4):
+        if image_format not in self.EXTENSIONS:
+            raise ValueError(f'Unsupported image format: {image_format}')
+
+        self.output_root = output_root
+        self.image_format = image_format
+        self.compress_level = compress_level
+        self.quality = quality
+        self.lossless = lossless
+        self.hash_index = hash_index
+        self.max_hash_distance = max_hash_distance
+
+        self.written = 0
+        self.duplicates = 0
+        self.encode_seconds = 0.0
+
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='image-writer')
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._pending = 0
+        self._reserved_paths = set()
+        self._pending_hashes: dict[str, int] = {}  # Of images queued but not yet written, by path
+        self._created_root = False
+        self._condition = threading.Condition()
+
+    @property
+    def queue_depth(self) -> int:
+        return self._pending
+
+    def submit(self, image: 'Image.Image', file_name, png_info: 'PngImagePlugin.PngInfo' = None) -> Future:
+        """
+        Queues the image to be saved as output_root/file_name.<extension>. The future resolves to the saved path,
+        or to None if the image was a near-duplicate and not saved.
+        """
+        image.load()  # Decode here so worker threads never race on lazy loading
+        image_hash = self._hash(image) if self.hash_index is not None else None
+
+        self._slots.acquire()
+        with self._condition:
+            if image_hash is not None and self._is_duplicate(image_hash):
+                self._slots.release()
+                future = Future()
+                future.set_result(None)
+                return future
+            path = self._reserve_path(file_name)
+            if image_hash is not None:
+                self._pending_hashes[path] = image_hash
+            self._pending += 1
+
+        future = self._executor.submit(self._write, image, path, png_info, image_hash)
+        future.add_done_callback(lambda _: self._finish(path))
+        return future
+
+    def flush(self):
+        """
+        Blocks until every queued image has been written
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._pending == 0)
+
+    def stats(self) -> dict:
+        return {
+            'queue_depth': self.queue_depth,
+            'written': self.written,
+            'duplicates': self.duplicates,
+            'encode_seconds': self.encode_seconds,
+            'mean_encode_seconds': self.encode_seconds / self.written if self.written else 0.0,
+        }
+
+    def _reserve_path(self, file_name) -> str:
+        if not self._created_root:
+            os.makedirs(self.output_root, exist_ok=True)
+            self._created_root = True
+
+        extension = self.EXTENSIONS[self.image_format]
+        path = os.path.join(self.output_root, f'{file_name}.{extension}')
+        i = 1
+        while path in self._reserved_paths or os.path.exists(path):
+            path = os.path.join(self.output_root, f'{file_name}_{i}.{extension}')
+            i += 1
+        self._reserved_paths.add(path)
+        return path
+
+    def _hash(self, image: 'Image.Image') -> int:
+        with instrumentation.span('image.hash', kind=self.hash_index.kind):
+            return self.hash_index.hash(image)
+
+    def _is_duplicate(self, image_hash) -> bool:
+        """
+        Whether an image being written, or an indexed image whose file still exists, is within max_hash_distance
+        """
+        being_written = any(bin(image_hash ^ other).count('1') <= self.max_hash_distance
+                            for other in self._pending_hashes.values())
+        if not being_written and not any(os.path.exists(path) for path, _ in
+                                         self.hash_index.find_duplicates(image_hash, self.max_hash_distance)):
+            return False
+        self.duplicates += 1
+        instrumentation.count('images_skipped_total', reason='duplicate')
+        return True
+
+    def _write(self, image: 'Image.Image', path, png_info, image_hash=None) -> str:
+        t0 = perf_counter()
+        directory, name = os.path.split(path)
+        temp_path = os.path.join(directory, f'.{name}.tmp')  # Unique, as the path is reserved
+        with instrumentation.span('image.write', format=self.image_format) as span:
+            try:
+                with open(temp_path, 'wb') as file:
+                    image.save(file, format=self.image_format, **self._encoder_options(png_info))
+                    num_bytes = file.tell()
+                os.replace(temp_path, path)
+            except BaseException:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+            span.set(bytes=num_bytes)
+        if image_hash is not None:
+            self.hash_index.add(image_hash, path)
+        instrumentation.count('images_written_total', format=self.image_format)
+        instrumentation.count('image_bytes_written_total', num_bytes)
+
+        with self._condition:
+            self.written += 1
+            self.encode_seconds += perf_counter() - t0
+        return path
+
+    def _encoder_options(self, png_info) -> dict:
+        if self.image_format == 'png':
+            return {'pnginfo': png_info, 'compress_level': self.compress_level}
+        if self.image_format == 'webp':
+            return {'quality': self.quality, 'lossless': self.lossless}
+        return {'quality': self.quality}
+
+    def _finish(self, path):
+        with self._condition:
+            self._pending -= 1
+            self._reserved_paths.discard(path)
+            self._pending_hashes.pop(path, None)
+            self._condition.notify_all()
+        self._slots.release()
+
+
+image_writer = ImageWriter()
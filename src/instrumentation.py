@@ -0,0 +1,220 @@
+import bisect
+import itertools
+import json
+import os
+import threading
+from time import perf_counter, time
+
+
+class LatencyHistogram:
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, float('inf'))
+
+    def __init__(self):
+        self.counts = [0] * len(self.BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            self.count += 1
+            self.total += seconds
+
+    def percentile(self, q) -> float:
+        """
+        Upper bound of the bucket containing the q-th percentile (0-100)
+        """
+        rank = q / 100 * self.count
+        seen = 0
+        for upper_bound, count in zip(self.BUCKETS, self.counts):
+            seen += count
+            if count and seen >= rank:
+                return upper_bound
+        return 0.0
+
+    def __str__(self):
+        mean = self.total / self.count if self.count else 0.0
+        return f'n={self.count} mean={mean:.2f}s p50<={self.percentile(50)}s p99<={self.percentile(99)}s'
+
+
+class Span:
+    """
+    A timed operation. Use as a context manager; set() adds attributes, e.g. bytes received, before it ends.
+    """
+    __slots__ = ('name', 'attributes', 'id', 'parent_id', 'started_at', '_t0', '_instrumentation')
+
+    def __init__(self, instrumentation: 'Instrumentation', name, attributes: dict, id, parent_id=None):
+        self.name = name
+        self.attributes = attributes
+        self.id = id
+        self.parent_id = parent_id
+        self.started_at: float = None
+        self._t0: float = None
+        self._instrumentation = instrumentation
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        self._instrumentation._stack().append(self)
+        self.started_at = time()
+        self._t0 = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        duration = perf_counter() - self._t0
+        self._instrumentation._stack().pop()
+        error = None if exc is None else repr(exc)
+        self._instrumentation._finish(self.name, self.started_at, duration, self.attributes, error, self.id,
+                                      self.parent_id)
+        return False
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class Instrumentation:
+    """
+    Spans and counters for finding out where a run spends its time. Disabled by default, in which case span()
+    returns a shared no-op span and count() returns straight away.
+
+    Finished spans are appended to a JSON-lines trace file, if one was given, and their durations are kept in a
+    histogram per span name. prometheus() renders the counters and histograms in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._trace_file = None
+        self._ids = itertools.count(1)
+        self._local = threading.local()
+        self._counters: dict[tuple[str, tuple], float] = {}
+        self._histograms: dict[str, LatencyHistogram] = {}
+        self._lock = threading.Lock()
+
+    def enable(self, trace_path=None):
+        if trace_path is not None:
+            directory = os.path.dirname(trace_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._trace_file = open(trace_path, 'a', encoding='utf-8')
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+        with self._lock:
+            if self._trace_file is not None:
+                self._trace_file.close()
+                self._trace_file = None
+
+    def span(self, name, **attributes) -> Span or _NoopSpan:
+        if not self.enabled:
+            return _NOOP_SPAN
+        stack = self._stack()
+        return Span(self, name, attributes, next(self._ids), stack[-1].id if stack else None)
+
+    def record(self, name, started_at, duration, error=None, **attributes):
+        """
+        Records a span that was timed elsewhere, e.g. a stream read on another thread
+        """
+        if self.enabled:
+            self._finish(name, started_at, duration, attributes, error, next(self._ids), None)
+
+    def count(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def counters(self) -> dict[str, float]:
+        with self._lock:
+            return {name + _format_labels(labels): value for (name, labels), value in sorted(self._counters.items())}
+
+    def histograms(self) -> dict[str, LatencyHistogram]:
+        with self._lock:
+            return dict(self._histograms)
+
+    def prometheus(self) -> str:
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items())
+
+        previous_name = None
+        for (name, labels), value in counters:
+            if name != previous_name:
+                lines.append(f'# TYPE {name} counter')
+                previous_name = name
+            lines.append(f'{name}{_format_labels(labels)} {value}')
+
+        if histograms:
+            lines.append('# TYPE span_duration_seconds histogram')
+        for span_name, histogram in histograms:
+            cumulative = 0
+            for upper_bound, count in zip(histogram.BUCKETS, histogram.counts):
+                cumulative += count
+                le = '+Inf' if upper_bound == float('inf') else str(upper_bound)
+                lines.append(f'span_duration_seconds_bucket{_format_labels((("span", span_name), ("le", le)))} '
+                             f'{cumulative}')
+            labels = _format_labels((('span', span_name),))
+            lines.append(f'span_duration_seconds_sum{labels} {histogram.total}')
+            lines.append(f'span_duration_seconds_count{labels} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as file:
+            file.write(self.prometheus())
+        os.replace(temp_path, path)
+
+    def _stack(self) -> list[Span]:
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _finish(self, name, started_at, duration, attributes, error, id, parent_id):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = LatencyHistogram()
+        histogram.record(duration)
+        if error is not None:
+            self.count('span_errors_total', span=name)
+
+        if self._trace_file is None:
+            return
+        line = json.dumps({
+            'id': id, 'parent_id': parent_id, 'name': name, 'start': started_at, 'duration': duration,
+            'thread': threading.current_thread().name, 'error': error, 'attributes': attributes,
+        }, default=str)
+        with self._lock:
+            if self._trace_file is not None:
+                self._trace_file.write(line + '\n')
+                self._trace_file.flush()
+
+
+def _format_labels(labels: tuple[tuple[str, object], ...]) -> str:
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+instrumentation = Instrumentation()
+if os.environ.get('TRACE_FILE'):
+    instrumentation.enable(os.environ['TRACE_FILE'])
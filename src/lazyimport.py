@@ -0,0 +1,38 @@
+import importlib
+import importlib.util
+
+
+class LazyModule:
+    """
+    Stands in for a module and only imports it when one of its attributes is first used, so that scripts do not
+    pay at startup for dependencies they may never need. Annotations that use a lazy module's attributes must be
+    quoted, as they are evaluated when the function is defined.
+    """
+
+    def __init__(self, name):
+        object.__setattr__(self, '_name', name)
+        object.__setattr__(self, '_module', None)
+
+    @classmethod
+    def optional(cls, name) -> 'LazyModule' or None:
+        """
+        A lazy module, or None if the module is not installed
+        """
+        return cls(name) if importlib.util.find_spec(name) is not None else None
+
+    def __getattr__(self, attribute):
+        return getattr(self._load(), attribute)
+
+    def __setattr__(self, attribute, value):
+        setattr(self._load(), attribute, value)
+
+    def __repr__(self):
+        return f'<lazy module {self._name!r}{" (imported)" if self._module is not None else ""}>'
+
+    def _load(self):
+        module = self._module
+        if module is None:
+            # The import system's module locks make concurrent first uses wait for a single import
+            module = importlib.import_module(self._name)
+            object.__setattr__(self, '_module', module)
+        return module
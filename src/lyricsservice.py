@@ -0,0 +1,131 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from time import monotonic, perf_counter, sleep, time
+
+from src.cache import LRUStore
+from src.instrumentation import LatencyHistogram, instrumentation
+from src.models import Track
+from src.openaihandler import OpenAI
+from src.spotifyhandler import Spotify, spotify
+
+
+class TokenBucket:
+    """
+    Rate limiter allowing `rate` calls per second on average, in bursts of up to `capacity`
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+        self._tokens = self.capacity
+        self._updated_at = monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            sleep(wait)
+
+
+class LyricsService:
+    """
+    Fetches lyrics and GPT summaries for a set of tracks. Each track's summary is requested as soon as its lyrics
+    arrive. Each backend has its own rate limit. Lyrics lookups are cached, and so are tracks that have no lyrics,
+    each with its own TTL.
+
+    histograms: latencies of lyrics lookups, summaries and whole tracks, from the start of a track's lookup until
+    its summary is done. Track latencies are also recorded as `lyrics.track` spans.
+    """
+    DAY = 24 * 60 * 60
+
+    def __init__(self, client: Spotify = None, cache: LRUStore = None, lyrics_rate=5, summary_rate=3,
+                 fetch_workers=10, summary_workers=5, lyrics_ttl=30 * DAY, no_lyrics_ttl=7 * DAY):
+        self._client = client or spotify
+        self.cache = cache
+        self.lyrics_ttl = lyrics_ttl
+        self.no_lyrics_ttl = no_lyrics_ttl
+
+        self._lyrics_limit = TokenBucket(lyrics_rate)
+        self._summary_limit = TokenBucket(summary_rate)
+        self._fetch_workers = fetch_workers
+        self._summary_workers = summary_workers
+
+        self.histograms = {
+            'lyrics': LatencyHistogram(),
+            'summary': LatencyHistogram(),
+            'track': LatencyHistogram(),
+        }
+
+    def get_lyrics(self, track_id) -> list[str]:
+        """
+        Returns the track's lyric lines, or an empty list if it has none. Failed lookups raise and are not cached.
+        """
+        cache_key = f'lyrics:{track_id}'
+        if self.cache is not None:
+            entry = self.cache.get(cache_key)
+            if entry is not None and entry.is_fresh:
+                return entry.value
+
+        self._lyrics_limit.acquire()
+        t0 = perf_counter()
+        lyrics = self._client.get_lyrics(track_id)
+        self.histograms['lyrics'].record(perf_counter() - t0)
+
+        if self.cache is not None:
+            ttl = self.lyrics_ttl if lyrics else self.no_lyrics_ttl
+            self.cache.put(cache_key, lyrics, expires_at=time() + ttl)
+        return lyrics
+
+    def summarise(self, lyrics: list[str]) -> str:
+        self._summary_limit.acquire()
+        t0 = perf_counter()
+        summary = OpenAI.summarise_song_lyrics(lyrics)
+        self.histograms['summary'].record(perf_counter() - t0)
+        return summary
+
+    def get_summaries(self, tracks: list[Track]) -> dict[str, str or None]:
+        """
+        Returns each track name mapped to its lyric summary, or None if it has no lyrics or they could not be
+        fetched, in track order
+        """
+        summaries: list[str or None] = [None] * len(tracks)
+        started_at = [0.0] * len(tracks)
+
+        def fetch(i):
+            started_at[i] = perf_counter()
+            return self.get_lyrics(tracks[i].id)
+
+        def finish(i):
+            duration = perf_counter() - started_at[i]
+            self.histograms['track'].record(duration)
+            instrumentation.record('lyrics.track', time() - duration, duration)
+
+        with ThreadPoolExecutor(self._fetch_workers) as fetch_pool, \
+                ThreadPoolExecutor(self._summary_workers) as summary_pool:
+            lyrics_futures = {fetch_pool.submit(fetch, i): i for i in range(len(tracks))}
+            summary_futures: dict[Future, int] = {}
+            for lyrics_future in as_completed(lyrics_futures):
+                i = lyrics_futures[lyrics_future]
+                try:
+                    lyrics = lyrics_future.result()
+                except Exception as e:  # Not cached, so the track is looked up again next time
+                    print(f'Could not get lyrics for {tracks[i].name}: {e!r}')
+                    lyrics = []
+                if lyrics:
+                    summary_futures[summary_pool.submit(self.summarise, lyrics)] = i
+                else:
+                    finish(i)
+
+            for summary_future in as_completed(summary_futures):
+                i = summary_futures[summary_future]
+                summaries[i] = summary_future.result()
+                finish(i)
+
+        return dict(zip([track.name for track in tracks], summaries))
@@ -0,0 +1,115 @@
+import sys
+from typing import Iterator
+
+
+class Track:
+    """
+    The fields of a Spotify track object that are actually used
+    """
+    __slots__ = ('id', 'name', 'album_id', 'artist_ids')
+
+    def __init__(self, id, name, album_id=None, artist_ids: tuple[str, ...] = ()):
+        self.id = id
+        self.name = name
+        self.album_id = album_id
+        self.artist_ids = artist_ids
+
+    @classmethod
+    def from_api_response(cls, api_response) -> 'Track':
+        album = api_response.get('album') or {}
+        artist_ids = tuple(_intern(artist['id']) for artist in api_response.get('artists', []) if artist.get('id'))
+        return cls(api_response.get('id'), api_response['name'], _intern(album.get('id')), artist_ids)
+
+
+class Album:
+    __slots__ = ('id', 'name', 'genres', 'artist_ids')
+
+    def __init__(self, id, name, genres: list[str], artist_ids: tuple[str, ...] = ()):
+        self.id = id
+        self.name = name
+        self.genres = genres
+        self.artist_ids = artist_ids
+
+    @classmethod
+    def from_api_response(cls, api_response) -> 'Album':
+        artist_ids = tuple(_intern(artist['id']) for artist in api_response.get('artists', []) if artist.get('id'))
+        return cls(api_response['id'], api_response['name'], api_response.get('genres', []), artist_ids)
+
+
+class Artist:
+    __slots__ = ('id', 'name', 'genres')
+
+    def __init__(self, id, name, genres: list[str]):
+        self.id = id
+        self.name = name
+        self.genres = genres
+
+    @classmethod
+    def from_api_response(cls, api_response) -> 'Artist':
+        return cls(api_response['id'], api_response['name'], api_response.get('genres', []))
+
+
+class TrackTable:
+    """
+    A playlist's tracks stored column-wise, one list per field rather than one object per track.
+    Album and artist ids are interned, so ids repeated across tracks are stored once.
+    """
+    __slots__ = ('ids', 'names', 'album_ids', 'artist_ids')
+
+    def __init__(self, tracks: list[Track] = ()):
+        self.ids: list[str] = []
+        self.names: list[str] = []
+        self.album_ids: list[str] = []
+        self.artist_ids: list[tuple[str, ...]] = []
+        for track in tracks:
+            self.append(track)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, index) -> Track:
+        return Track(self.ids[index], self.names[index], self.album_ids[index], self.artist_ids[index])
+
+    def __iter__(self) -> Iterator[Track]:
+        for row in zip(self.ids, self.names, self.album_ids, self.artist_ids):
+            yield Track(*row)
+
+    def append(self, track: Track):
+        self.ids.append(track.id)
+        self.names.append(track.name)
+        self.album_ids.append(track.album_id)
+        self.artist_ids.append(track.artist_ids)
+
+    def extend(self, tracks):
+        for track in tracks:
+            self.append(track)
+
+    @classmethod
+    def from_api_response(cls, playlist_items: list[dict]) -> 'TrackTable':
+        """
+        playlist_items: the `items` of playlist track pages. Entries without a track, e.g. removed local files,
+        are skipped.
+        """
+        table = cls()
+        table.extend(Track.from_api_response(item['track']) for item in playlist_items if item.get('track'))
+        return table
+
+    def to_dict(self) -> dict:
+        return {'ids': self.ids, 'names': self.names, 'album_ids': self.album_ids, 'artist_ids': self.artist_ids}
+
+    @classmethod
+    def from_dict(cls, columns: dict) -> 'TrackTable':
+        """
+        Inverse of to_dict, e.g. after a JSON round trip
+        """
+        table = cls()
+        table.ids = columns['ids']
+        table.names = columns['names']
+        table.album_ids = [_intern(album_id) for album_id in columns['album_ids']]
+        table.artist_ids = [tuple(_intern(artist_id) for artist_id in artist_ids)
+                            for artist_ids in columns['artist_ids']]
+        return table
+
+
+def _intern(value: str or None) -> str or None:
+    return sys.intern(value) if value is not None else None
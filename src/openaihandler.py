@@ -1,6 +1,14 @@
-import openai
+import threading
+from time import perf_counter, time
+from typing import Iterator
 
+from src.cache import CompletionCache
+from src.instrumentation import instrumentation
+from src.lazyimport import LazyModule
 from src.spotifyhandler import SpotifyAlbum
+from src.tokenpacker import TokenPacker
+
+openai = LazyModule('openai')
 
 
 class Models:
@@ -8,22 +16,102 @@ class Models:
     GPT_4 = 'gpt-4'
 
 
+class CompletionStream:
+    """
+    One choice of a streamed chat completion. Tokens are buffered as they arrive on a background thread, so the
+    stream can be iterated from the start, any number of times, while the completion is still being received.
+    """
+
+    def __init__(self, started_at: float = None, process_tokens=None):
+        self._tokens: list[str] = []
+        self._done = False
+        self._error: Exception = None
+        self._condition = threading.Condition()
+        self._process_tokens = process_tokens
+
+        self.started_at = started_at or perf_counter()
+        self.time_to_first_token: float = None
+        self.total_time: float = None
+        self.prompt_tokens: int = None
+        self.packed_tokens: int = None  # Of the song titles or summaries packed into the prompt
+
+    def __iter__(self) -> Iterator[str]:
+        tokens = self._iter_received()
+        if self._process_tokens is not None:
+            tokens = self._process_tokens(tokens)
+        return iter(tokens)
+
+    def read(self) -> str:
+        """
+        Blocks until the completion has finished and returns the full text
+        """
+        return ''.join(self)
+
+    def append(self, token: str):
+        with self._condition:
+            if self.time_to_first_token is None:
+                self.time_to_first_token = perf_counter() - self.started_at
+            self._tokens.append(token)
+            self._condition.notify_all()
+
+    def finish(self, error: Exception = None):
+        with self._condition:
+            self._done = True
+            self._error = error
+            self.total_time = perf_counter() - self.started_at
+            self._condition.notify_all()
+
+    def _iter_received(self) -> Iterator[str]:
+        i = 0
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: i < len(self._tokens) or self._done)
+                if i == len(self._tokens):
+                    if self._error is not None:
+                        raise self._error
+                    return
+                token = self._tokens[i]
+            yield token
+            i += 1
+
+
 class OpenAI:
+    completion_cache: CompletionCache = None
+    title_token_budget = 1000
+    summary_token_budget = 3000
+
     @classmethod
-    def summarise_genre(cls, genres: list[str]) -> str:
-        system_prompt = 'I will provide you with a list of genres describing music on a playlist.' \
+    def summarise_genre(cls, genres: list[tuple[str, float]]) -> str:
+        """
+        genres: (genre, share of the playlist's tracks) pairs, heaviest first
+        """
+        system_prompt = 'I will provide you with the genres describing music on a playlist, each with the share of' \
+                        ' the playlist it describes.' \
                         ' Please summarise the genre and mood of the playlist using just a few terms.'
 
         roles_and_messages = [
             ('system', system_prompt),
-            ('user', '\n'.join(genres))
+            ('user', '\n'.join(f'{genre}: {share:.0%}' for genre, share in genres))
         ]
         genre_completion = cls._chat_complete(roles_and_messages, model=Models.GPT_3_5_TURBO)
         genre_completion = cls._replace_whitespace(genre_completion)
         return genre_completion
 
     @classmethod
-    def get_txt2img_playlist_prompt(cls, playlist_genre, track_names) -> str:
+    def get_txt2img_playlist_prompt(cls, playlist_genre, track_names, stream=False,
+                                    token_budget=None) -> str or CompletionStream:
+        return cls.get_txt2img_playlist_prompts(playlist_genre, track_names, 1, stream, token_budget)[0]
+
+    @classmethod
+    def get_txt2img_playlist_prompts(cls, playlist_genre, track_names, n, stream=False,
+                                     token_budget=None) -> list[str] or list[CompletionStream]:
+        """
+        Generates n prompts from a single completion, so the song titles are only sent once.
+        Titles are deduplicated and packed in order into token_budget tokens (default: title_token_budget).
+        """
+        track_names, packed_tokens = TokenPacker.pack(TokenPacker.dedupe_titles(track_names),
+                                                      token_budget or cls.title_token_budget, Models.GPT_4)
+
         system_prompt = 'I am trying to generate an image based on song titles.' \
                         ' You generate a prompt to provide a txt2img model.' \
                         ' The prompt should just be a list of comma separated phrases.'
@@ -43,12 +131,20 @@ class OpenAI:
             ('system', system_prompt),
             ('user', user_prompt)
         ]
+        return cls._complete_prompts(roles_and_messages, n, stream, packed_tokens)
 
-        gpt_response = cls._chat_complete(roles_and_messages)
-        return cls._process_response(gpt_response)
+    @classmethod
+    def get_img2img_album_prompt(cls, song_lyrics: dict[str, str], stream=False,
+                                 token_budget=None) -> str or CompletionStream:
+        return cls.get_img2img_album_prompts(song_lyrics, 1, stream, token_budget)[0]
 
     @classmethod
-    def get_img2img_album_prompt(cls, song_lyrics: dict[str, str]):
+    def get_img2img_album_prompts(cls, song_lyrics: dict[str, str], n, stream=False,
+                                  token_budget=None) -> list[str] or list[CompletionStream]:
+        """
+        Generates n prompts from a single completion, so the lyric summaries are only sent once.
+        Summaries are packed in order into token_budget tokens (default: summary_token_budget).
+        """
         system_prompt = "I am trying to generate an album cover based on descriptions of the songs on the album." \
                         " I will provide you a series of descriptions, and you will generate a prompt." \
                         " A prompt is just phrases separated by commas on one line." \
@@ -57,13 +153,15 @@ class OpenAI:
                         '\n - Be no more than 4 sentences or 50 words' \
                         '\n\nUse a mix of concrete and abstract terms to describe the album cover.' \
                         ' Remember that the image should be coherent, so do not describe too many different things.'
-        lyrics_prompt = '\n\n'.join([song_lyric for song_lyric in song_lyrics.values() if song_lyric])
+        summaries = [song_lyric for song_lyric in song_lyrics.values() if song_lyric]
+        song_lyrics, packed_tokens = TokenPacker.pack(summaries, token_budget or cls.summary_token_budget,
+                                                      Models.GPT_4, separator='\n\n')
+        lyrics_prompt = '\n\n'.join(song_lyrics)
         roles_and_messages = [
             ('system', system_prompt),
             ('user', lyrics_prompt)
         ]
-        gpt_response = cls._chat_complete(roles_and_messages)
-        return cls._process_response(gpt_response)
+        return cls._complete_prompts(roles_and_messages, n, stream, packed_tokens)
 
     @classmethod
     def summarise_song_lyrics(cls, lyrics: list[str]) -> str:
@@ -79,10 +177,118 @@ class OpenAI:
         return lyric_summary
 
     @classmethod
-    def _chat_complete(cls, roles_and_messages: list[tuple[str, str]], model=Models.GPT_4, **kwargs) -> str:
+    def _chat_complete(cls, roles_and_messages: list[tuple[str, str]], model=Models.GPT_4, cache=True,
+                       **kwargs) -> str:
+        """
+        cache: reuse an earlier completion for identical inputs. Pass False where each call should sample a new
+        response.
+        """
+        prompt = [{'role': role, 'content': message} for role, message in roles_and_messages]
+
+        with instrumentation.span('openai.chat', model=model) as span:
+            cache_key = None
+            if cache and cls.completion_cache is not None:
+                cache_key = CompletionCache.key(model, prompt, **kwargs)
+                completion = cls.completion_cache.get(cache_key)
+                if completion is not None:
+                    span.set(cached=True)
+                    instrumentation.count('openai_requests_total', model=model, cached=True)
+                    return completion
+
+            response = cls._create_chat_completion(model=model, messages=prompt, stream=False, **kwargs)
+            completion = response.choices[0]['message']['content']
+            cls._record_usage(span, model, response)
+
+        if cache_key is not None:
+            cls.completion_cache.put(cache_key, completion)
+        return completion
+
+    @classmethod
+    def _chat_complete_choices(cls, roles_and_messages: list[tuple[str, str]], n, model=Models.GPT_4,
+                               packed_tokens=None, **kwargs) -> list[str]:
+        """
+        Samples n completions of the same messages in one request. Never cached.
+        packed_tokens: recorded on the request's span
+        """
         prompt = [{'role': role, 'content': message} for role, message in roles_and_messages]
-        response = openai.ChatCompletion.create(model=model, messages=prompt, stream=False, **kwargs)
-        return response.choices[0]['message']['content']
+        with instrumentation.span('openai.chat', model=model, n=n, packed_tokens=packed_tokens) as span:
+            response = cls._create_chat_completion(model=model, messages=prompt, n=n, stream=False, **kwargs)
+            cls._record_usage(span, model, response)
+        choices = sorted(response.choices, key=lambda choice: choice['index'])
+        return [choice['message']['content'] for choice in choices]
+
+    @classmethod
+    def _chat_complete_stream(cls, roles_and_messages: list[tuple[str, str]], n=1, model=Models.GPT_4,
+                              process_tokens=None, packed_tokens=None, **kwargs) -> list[CompletionStream]:
+        """
+        Starts a streamed completion with n choices. Blocks until the response headers arrive; the tokens are then
+        read on a background thread. Streamed completions are never cached.
+        packed_tokens: recorded on the span and on each stream
+        """
+        started_at = perf_counter()
+        prompt = [{'role': role, 'content': message} for role, message in roles_and_messages]
+        with instrumentation.span('openai.stream_start', model=model, n=n, packed_tokens=packed_tokens):
+            response = cls._create_chat_completion(model=model, messages=prompt, n=n, stream=True, **kwargs)
+
+        streams = [CompletionStream(started_at, process_tokens) for _ in range(n)]
+        prompt_tokens = TokenPacker.count_message_tokens(prompt, model)
+        for stream in streams:
+            stream.prompt_tokens = prompt_tokens
+            stream.packed_tokens = packed_tokens
+        threading.Thread(target=cls._read_stream, args=(response, streams, model), daemon=True).start()
+        return streams
+
+    @classmethod
+    def _create_chat_completion(cls, **kwargs):
+        if openai.api_key is None:
+            import secret  # Sets openai.api_key
+        return openai.ChatCompletion.create(**kwargs)
+
+    @classmethod
+    def _read_stream(cls, response, streams: list[CompletionStream], model=None):
+        error = None
+        num_tokens = 0
+        try:
+            for chunk in response:
+                for choice in chunk.choices:
+                    token = choice['delta'].get('content')
+                    if token:
+                        streams[choice['index']].append(token)
+                        num_tokens += 1
+        except Exception as e:
+            error = e
+        finally:
+            for stream in streams:
+                stream.finish(error)
+
+        # Streams report no usage; each content delta is one token and the prompt was counted locally
+        stream = streams[0]
+        instrumentation.record('openai.stream', time() - stream.total_time, stream.total_time,
+                               None if error is None else repr(error), model=model, n=len(streams),
+                               time_to_first_token=stream.time_to_first_token, prompt_tokens=stream.prompt_tokens,
+                               completion_tokens=num_tokens)
+        instrumentation.count('openai_requests_total', model=model, cached=False)
+        instrumentation.count('openai_tokens_total', stream.prompt_tokens or 0, model=model, kind='prompt')
+        instrumentation.count('openai_tokens_total', num_tokens, model=model, kind='completion')
+
+    @classmethod
+    def _record_usage(cls, span, model, response):
+        usage = response.get('usage') or {}
+        prompt_tokens, completion_tokens = usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0)
+        span.set(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+        instrumentation.count('openai_requests_total', model=model, cached=False)
+        instrumentation.count('openai_tokens_total', prompt_tokens, model=model, kind='prompt')
+        instrumentation.count('openai_tokens_total', completion_tokens, model=model, kind='completion')
+
+    @classmethod
+    def _complete_prompts(cls, roles_and_messages, n, stream,
+                          packed_tokens=None) -> list[str] or list[CompletionStream]:
+        if stream:
+            return cls._chat_complete_stream(roles_and_messages, n=n, process_tokens=cls._process_stream,
+                                             packed_tokens=packed_tokens)
+
+        gpt_responses = cls._chat_complete_choices(roles_and_messages, n, packed_tokens=packed_tokens)
+        return [cls._process_response(gpt_response) for gpt_response in gpt_responses]
 
     @classmethod
     def _process_response(cls, gpt_response: str):
@@ -96,3 +302,39 @@ class OpenAI:
     @classmethod
     def _replace_whitespace(cls, text: str) -> str:
         return text.strip().replace('\n', ' ').replace('\t', ' ')
+
+    @classmethod
+    def _process_stream(cls, tokens: Iterator[str]) -> Iterator[str]:
+        """
+        Incremental _process_response: one quote is dropped from each end, then whitespace. Leading characters are
+        dropped as they arrive; trailing whitespace and quotes are held back until more text follows them.
+        """
+        pending = ''
+        first = True
+        started = False
+        for token in tokens:
+            if not token:
+                continue
+            if first:
+                first = False
+                if token.startswith('"'):
+                    token = token[1:]
+
+            text = pending + token
+            if not started:
+                text = text.lstrip()
+                if not text:
+                    continue
+                started = True
+
+            body = text.rstrip()
+            if body.endswith('"'):
+                body = body[:-1].rstrip()
+            pending = text[len(body):]
+            if body:
+                yield body
+
+        if pending.endswith('"'):
+            pending = pending[:-1]
+        if pending.rstrip():
+            yield pending.rstrip()
@@ -0,0 +1,189 @@
+import os
+import threading
+from functools import lru_cache
+
+from src.lazyimport import LazyModule
+
+np = LazyModule('numpy')
+Image = LazyModule('PIL.Image')
+
+
+class PerceptualHash:
+    """
+    64-bit perceptual hashes. Similar-looking images get hashes a small Hamming distance apart.
+
+    dhash: compares the brightness of neighbouring pixels in a 9x8 thumbnail. Fast; robust to scaling and
+    compression.
+    phash: compares the low frequencies of a 32x32 thumbnail's DCT with their median. Slower; also robust to small
+    changes in brightness and contrast.
+    """
+    HASH_SIZE = 8
+    PHASH_SIZE = 32
+
+    @classmethod
+    def dhash(cls, image: 'Image.Image') -> int:
+        pixels = cls._grayscale(image, cls.HASH_SIZE + 1, cls.HASH_SIZE)
+        return cls._pack(pixels[:, 1:] > pixels[:, :-1])
+
+    @classmethod
+    def phash(cls, image: 'Image.Image') -> int:
+        pixels = cls._grayscale(image, cls.PHASH_SIZE, cls.PHASH_SIZE)
+        dct = _dct_matrix(cls.PHASH_SIZE)
+        low_frequencies = (dct @ pixels @ dct.T)[:cls.HASH_SIZE, :cls.HASH_SIZE]
+        return cls._pack(low_frequencies > np.median(low_frequencies))
+
+    @classmethod
+    def popcount(cls, values: 'np.ndarray') -> 'np.ndarray':
+        """
+        Number of set bits in each uint64
+        """
+        if hasattr(np, 'bitwise_count'):  # NumPy 2
+            return np.bitwise_count(values)
+        return _byte_popcounts()[values.view(np.uint8)].reshape(-1, 8).sum(axis=1, dtype=np.uint8)
+
+    @classmethod
+    def distances(cls, hashes: 'np.ndarray', image_hash: int) -> 'np.ndarray':
+        """
+        Hamming distance from image_hash to each of hashes, in one pass over the array
+        """
+        return cls.popcount(np.bitwise_xor(hashes, np.uint64(image_hash)))
+
+    @classmethod
+    def select_diverse(cls, hashes, count=None, max_distance=-1) -> list[int]:
+        """
+        Greedily picks up to count hashes that are as far apart as possible: the first hash, then repeatedly the one
+        farthest from every pick so far. Stops early once every remaining hash is within max_distance of a pick,
+        so with count=None this drops near-duplicates. Returns the picked indices in ascending order.
+        """
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        if len(hashes) == 0:
+            return []
+        count = len(hashes) if count is None else min(count, len(hashes))
+
+        picked = [0]
+        nearest = cls.distances(hashes, hashes[0]).astype(np.int16)  # Distance to the nearest pick
+        nearest[0] = -1
+        while len(picked) < count:
+            i = int(np.argmax(nearest))
+            if nearest[i] <= max_distance:
+                break
+            picked.append(i)
+            np.minimum(nearest, cls.distances(hashes, hashes[i]), out=nearest)
+            nearest[picked] = -1
+        return sorted(picked)
+
+    @classmethod
+    def _grayscale(cls, image: 'Image.Image', width, height) -> 'np.ndarray':
+        thumbnail = image.convert('L').resize((width, height), Image.LANCZOS, reducing_gap=2.0)
+        return np.asarray(thumbnail, dtype=np.float32)
+
+    @classmethod
+    def _pack(cls, bits: 'np.ndarray') -> int:
+        return int.from_bytes(np.packbits(bits.ravel()).tobytes(), 'big')
+
+
+@lru_cache(maxsize=None)
+def _byte_popcounts() -> 'np.ndarray':
+    return np.array([bin(byte).count('1') for byte in range(256)], dtype=np.uint8)
+
+
+@lru_cache(maxsize=None)
+def _dct_matrix(size) -> 'np.ndarray':
+    """
+    Orthonormal DCT-II matrix; M @ x @ M.T is the 2D DCT of x
+    """
+    k = np.arange(size).reshape(-1, 1)
+    n = np.arange(size).reshape(1, -1)
+    matrix = np.sqrt(2 / size) * np.cos(np.pi * (2 * n + 1) * k / (2 * size))
+    matrix[0] /= np.sqrt(2)
+    return matrix.astype(np.float32)
+
+
+class HashIndex:
+    """
+    Perceptual hashes of saved images. The hashes are stored in a memory-mapped uint64 array (`<path>.hashes`),
+    so a lookup is one vectorized XOR and popcount over every entry, and the image paths one per line in
+    `<path>.paths`. Safe to share between threads, but not between processes.
+
+    kind: 'dhash' or 'phash'. An index must always be opened with the same kind.
+    """
+
+    def __init__(self, path, kind='dhash', initial_capacity=1024):
+        if kind not in ('dhash', 'phash'):
+            raise ValueError(f'Unsupported hash kind: {kind}')
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.kind = kind
+        self._hashes_path = path + '.hashes'
+        self._paths_path = path + '.paths'
+        self._lock = threading.Lock()
+
+        self.paths: list[str] = []
+        if os.path.exists(self._paths_path):
+            with open(self._paths_path, encoding='utf-8') as file:
+                self.paths = [line.rstrip('\n') for line in file]
+        self._positions = {image_path: i for i, image_path in enumerate(self.paths)}
+
+        stored_capacity = os.path.getsize(self._hashes_path) // 8 if os.path.exists(self._hashes_path) else 0
+        self._hashes: 'np.memmap' = None
+        self._open(max(initial_capacity, stored_capacity, len(self.paths)))
+        self._paths_file = open(self._paths_path, 'a', encoding='utf-8')
+
+    def __len__(self):
+        return len(self.paths)
+
+    @property
+    def hashes(self) -> 'np.ndarray':
+        return self._hashes[:len(self.paths)]
+
+    def hash(self, image: 'Image.Image') -> int:
+        return getattr(PerceptualHash, self.kind)(image)
+
+    def get(self, image_path) -> int or None:
+        i = self._positions.get(os.path.abspath(image_path))
+        return None if i is None else int(self._hashes[i])
+
+    def add(self, image_hash: int, image_path):
+        with self._lock:
+            self._add(image_hash, os.path.abspath(image_path))
+
+    def find_duplicates(self, image_hash: int, max_distance) -> list[tuple[str, int]]:
+        """
+        Returns (path, distance) for every image within max_distance of image_hash, nearest first
+        """
+        with self._lock:
+            distances = PerceptualHash.distances(self.hashes, image_hash)
+        matches = np.flatnonzero(distances <= max_distance)
+        matches = matches[np.argsort(distances[matches], kind='stable')]
+        return [(self.paths[i], int(distances[i])) for i in matches]
+
+    def flush(self):
+        with self._lock:
+            self._hashes.flush()
+            self._paths_file.flush()
+
+    def close(self):
+        self.flush()
+        self._paths_file.close()
+
+    def _add(self, image_hash: int, image_path):
+        i = len(self.paths)
+        if i == len(self._hashes):
+            self._hashes.flush()
+            self._open(2 * len(self._hashes))
+
+        # The hash is written before its path, as the number of paths is the number of valid hashes
+        self._hashes[i] = image_hash
+        self._paths_file.write(image_path + '\n')
+        self._paths_file.flush()
+        self.paths.append(image_path)
+        self._positions[image_path] = i
+
+    def _open(self, capacity):
+        with open(self._hashes_path, 'ab') as file:
+            if file.tell() < capacity * 8:
+                file.truncate(capacity * 8)
+        self._hashes = np.memmap(self._hashes_path, dtype=np.uint64, mode='r+', shape=(capacity,))
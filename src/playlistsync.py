@@ -0,0 +1,60 @@
+import threading
+
+from src.cache import LRUStore
+from src.models import TrackTable
+from src.spotifyhandler import Spotify, spotify
+
+
+class PlaylistSync:
+    """
+    Local copy of playlists' tracks, stored with the playlist's snapshot_id. Spotify gives a playlist a new
+    snapshot_id whenever it is modified, so tracks are only refetched for playlists that changed since they were
+    last stored. Listings are always revalidated with Spotify so that their snapshot ids are current.
+    """
+    PLAYLIST_FIELDS = 'id,name,snapshot_id'
+
+    def __init__(self, store: LRUStore, client: Spotify = None):
+        self.store = store
+        self._client = client or spotify
+
+        self._lock = threading.Lock()
+        self.unchanged = 0
+        self.fetched = 0
+
+    @classmethod
+    def key(cls, playlist_id) -> str:
+        return f'playlist:{playlist_id}'
+
+    def get_playlists(self, user_id) -> list[dict]:
+        return self._client.get_playlists(user_id, revalidate=True)
+
+    def get_playlist(self, playlist_id) -> dict:
+        return self._client.get_playlist(playlist_id, self.PLAYLIST_FIELDS, revalidate=True)
+
+    def get_tracks(self, playlist_id, snapshot_id=None) -> TrackTable:
+        """
+        Returns the stored tracks if the playlist is still at snapshot_id, otherwise fetches and stores them.
+        snapshot_id: from a playlist listing; looked up if not given
+        """
+        if snapshot_id is None:
+            snapshot_id = self.get_playlist(playlist_id)['snapshot_id']
+
+        entry = self.store.get(self.key(playlist_id))
+        if entry is not None and entry.value['snapshot_id'] == snapshot_id:
+            with self._lock:
+                self.unchanged += 1
+            return TrackTable.from_dict(entry.value['tracks'])
+
+        # Tracks pages may still be in the response cache from before the change
+        tracks = self._client.get_tracks(playlist_id, revalidate=True)
+        self.store.put(self.key(playlist_id), {'snapshot_id': snapshot_id, 'tracks': tracks.to_dict()})
+        with self._lock:
+            self.fetched += 1
+        return tracks
+
+    def stats(self) -> dict:
+        return {
+            'unchanged': self.unchanged,
+            'fetched': self.fetched,
+            'bytes': self.store.size,
+        }
@@ -0,0 +1,45 @@
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable
+
+
+class PromptQueue:
+    """
+    Local queue of prompts that is refilled in batches. generate_prompts(n) should return n prompts, ideally from a
+    single request. The next batch is requested in the background once the queue drops to low_water prompts.
+    """
+
+    def __init__(self, generate_prompts: Callable[[int], list], batch_size=4, low_water=1):
+        self.batch_size = batch_size
+        self.low_water = low_water
+
+        self._generate_prompts = generate_prompts
+        self._prompts = deque()
+        self._next_batch: Future = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if not self._prompts:
+                if self._next_batch is None:
+                    self._request_batch()
+                try:
+                    batch = self._next_batch.result()
+                finally:
+                    self._next_batch = None  # A failed batch is requested again on the next get()
+                if not batch:
+                    raise ValueError('No prompts were generated')
+                self._prompts.extend(batch)
+
+            prompt = self._prompts.popleft()
+            if len(self._prompts) <= self.low_water and self._next_batch is None:
+                self._request_batch()
+            return prompt
+
+    def __len__(self):
+        return len(self._prompts)
+
+    def _request_batch(self):
+        self._next_batch = self._executor.submit(self._generate_prompts, self.batch_size)
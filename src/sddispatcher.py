@@ -0,0 +1,223 @@
+import threading
+from time import perf_counter
+from urllib.parse import urljoin
+
+from src.httpsession import HttpSession
+from src.instrumentation import instrumentation
+from src.lazyimport import LazyModule
+
+requests = LazyModule('requests')
+
+
+class SDBackend:
+    """
+    A webui instance and what the dispatcher knows about it.
+    url: the API root, e.g. 'http://127.0.0.1:7860/sdapi/v1/'
+    checkpoint: loaded by the last successful request, or reported by a health check. None if unknown.
+    """
+
+    def __init__(self, url):
+        self.url = url if url.endswith('/') else url + '/'
+        self.checkpoint: str or None = None
+        self.healthy = True
+        self.outstanding = 0
+        self.completed = 0
+        self.failed = 0
+        self.images = 0
+        self.checkpoint_switches = 0
+        self.consecutive_failures = 0
+        self.first_request_at: float = None
+        self.last_assigned_at = 0.0
+
+    @property
+    def images_per_minute(self) -> float:
+        if self.first_request_at is None:
+            return 0.0
+        elapsed = perf_counter() - self.first_request_at
+        return 60 * self.images / elapsed if elapsed else 0.0
+
+    def stats(self) -> dict:
+        return {
+            'healthy': self.healthy,
+            'checkpoint': self.checkpoint,
+            'queue_depth': self.outstanding,
+            'completed': self.completed,
+            'failed': self.failed,
+            'images': self.images,
+            'checkpoint_switches': self.checkpoint_switches,
+            'images_per_minute': self.images_per_minute,
+        }
+
+
+class SDDispatcher:
+    """
+    Spreads Stable Diffusion requests over several webui backends. Each request goes to the healthy backend with
+    the fewest outstanding requests, preferring one that already has the requested checkpoint loaded, as switching
+    makes a backend reload gigabytes of weights. Requests that could not connect or were turned away with a 429 are
+    retried on another backend; like StableDiffusion.session, a 5xx or a read timeout is not, as it may come after
+    the images were generated. A backend is taken out of rotation after max_failures consecutive failures and put
+    back once a health check succeeds.
+
+    affinity_slack: how many more outstanding requests a backend with the right checkpoint may have before a less
+    busy backend that has to switch checkpoints is used instead
+    health_interval: seconds between health checks once start() has been called
+    """
+
+    def __init__(self, urls: list[str], session: HttpSession = None, affinity=True, affinity_slack=2, max_failures=2,
+                 max_attempts=3, health_interval=15, health_timeout=5):
+        if not urls:
+            raise ValueError('At least one Stable Diffusion backend is required')
+
+        self.backends = [SDBackend(url) for url in urls]
+        self.affinity = affinity
+        self.affinity_slack = affinity_slack
+        self.max_failures = max_failures
+        self.max_attempts = max_attempts
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+
+        # Generation can take minutes, and 429s are retried on other backends rather than the same one
+        self._session = session or HttpSession(max_retries=0, timeout=600)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._health_thread: threading.Thread = None
+
+    def post(self, route, payload: dict) -> 'requests.Response':
+        checkpoint = payload.get('sd_model_checkpoint')
+        num_images = payload.get('batch_size', 1) * payload.get('n_iter', 1)
+
+        tried = set()
+        error: Exception = None
+        for _ in range(self.max_attempts):
+            backend = self._acquire(checkpoint, tried)
+            tried.add(backend.url)
+            try:
+                response = self._session.post(urljoin(backend.url, route), json=payload)
+            except requests.ConnectionError as e:
+                error = e
+                self._release(backend, succeeded=False)
+                continue
+            except requests.RequestException:
+                self._release(backend, succeeded=False)
+                raise
+
+            if response.status_code == 429 or response.status_code >= 500:
+                error = requests.HTTPError(f'{response.status_code} from {backend.url}', response=response)
+                self._release(backend, succeeded=False)
+                if response.status_code == 429:
+                    continue
+                raise error
+
+            self._release(backend, succeeded=True, checkpoint=checkpoint, num_images=num_images)
+            return response
+        raise error
+
+    def check_health(self):
+        """
+        Probes every backend's options route, which also reports the checkpoint it has loaded
+        """
+        for backend in self.backends:
+            try:
+                response = self._session.get(urljoin(backend.url, 'options'), timeout=self.health_timeout)
+                response.raise_for_status()
+                loaded_checkpoint = self._checkpoint_name(response.json().get('sd_model_checkpoint'))
+            except (requests.RequestException, ValueError):
+                with self._lock:
+                    self._mark_down(backend)
+                continue
+
+            with self._lock:
+                if not backend.healthy:
+                    instrumentation.count('sd_backend_up_total', backend=backend.url)
+                backend.healthy = True
+                backend.consecutive_failures = 0
+                if backend.outstanding == 0 and loaded_checkpoint:
+                    backend.checkpoint = loaded_checkpoint
+
+    def start(self):
+        """
+        Checks every backend now, then keeps checking them in the background every health_interval seconds
+        """
+        self.check_health()
+        self._stop.clear()
+        self._health_thread = threading.Thread(target=self._check_health_periodically, daemon=True)
+        self._health_thread.start()
+
+    def close(self):
+        self._stop.set()
+
+    def stats(self) -> dict[str, dict]:
+        with self._lock:
+            return {backend.url: backend.stats() for backend in self.backends}
+
+    def _check_health_periodically(self):
+        while not self._stop.wait(self.health_interval):
+            self.check_health()
+
+    def _acquire(self, checkpoint, tried: set[str]) -> SDBackend:
+        with self._lock:
+            healthy = [backend for backend in self.backends if backend.healthy]
+            if not healthy:
+                raise RuntimeError('No healthy Stable Diffusion backends')
+            backend = self._choose([backend for backend in healthy if backend.url not in tried] or healthy,
+                                   checkpoint)
+
+            has_checkpoint = checkpoint is None or backend.checkpoint == checkpoint
+            backend.outstanding += 1
+            backend.last_assigned_at = perf_counter()
+            if backend.first_request_at is None:
+                backend.first_request_at = backend.last_assigned_at
+
+        instrumentation.count('sd_dispatched_total', backend=backend.url, had_checkpoint=has_checkpoint)
+        return backend
+
+    def _choose(self, candidates: list[SDBackend], checkpoint) -> SDBackend:
+        least_busy = min(candidates, key=self._load)
+        if not self.affinity or checkpoint is None:
+            return least_busy
+
+        loaded = [backend for backend in candidates if backend.checkpoint == checkpoint]
+        if not loaded:
+            return least_busy
+        least_busy_loaded = min(loaded, key=self._load)
+        if least_busy_loaded.outstanding <= least_busy.outstanding + self.affinity_slack:
+            return least_busy_loaded
+        return least_busy
+
+    @classmethod
+    def _load(cls, backend: SDBackend) -> tuple[int, float]:
+        return backend.outstanding, backend.last_assigned_at  # Ties go to the backend used least recently
+
+    def _release(self, backend: SDBackend, succeeded, checkpoint=None, num_images=0):
+        """
+        checkpoint: the one the request asked for. Only recorded once a request succeeds, so affinity never follows
+        a checkpoint that failed to load.
+        """
+        with self._lock:
+            backend.outstanding -= 1
+            if succeeded:
+                if checkpoint is not None and backend.checkpoint != checkpoint:
+                    if backend.checkpoint is not None:
+                        backend.checkpoint_switches += 1
+                    backend.checkpoint = checkpoint
+                backend.completed += 1
+                backend.images += num_images
+                backend.consecutive_failures = 0
+                return
+
+            backend.failed += 1
+            backend.consecutive_failures += 1
+            if backend.consecutive_failures >= self.max_failures:
+                self._mark_down(backend)
+
+    def _mark_down(self, backend: SDBackend):
+        if backend.healthy:
+            instrumentation.count('sd_backend_down_total', backend=backend.url)
+        backend.healthy = False
+
+    @classmethod
+    def _checkpoint_name(cls, checkpoint: str or None) -> str or None:
+        """
+        The webui reports checkpoints as 'name.safetensors [hash]'; requests name them without the hash
+        """
+        return checkpoint.split(' [', 1)[0] if checkpoint else None
@@ -1,31 +1,72 @@
+import threading
 from datetime import datetime, timedelta
 from io import BytesIO
 from urllib.parse import urljoin
 
-import requests
-from PIL import Image
+from src.cache import ResponseCache
+from src.httpsession import HttpSession, http_session
+from src.instrumentation import instrumentation
+from src.lazyimport import LazyModule
+from src.models import Album, Artist, Track, TrackTable
 
-from secret import client_id, client_secret
+asyncio = LazyModule('asyncio')
+Image = LazyModule('PIL.Image')
+secret = LazyModule('secret')  # Only needed once a token is requested
 
 
 class AlbumImage:
+    """
+    Album artwork. The pixels are only decoded when `image` is first accessed.
+    """
+    __slots__ = ('image_bytes', '_image')
+
     def __init__(self, image_bytes):
-        self.image = Image.open(BytesIO(image_bytes))
         self.image_bytes = image_bytes
+        self._image = None
+
+    @property
+    def image(self) -> 'Image.Image':
+        if self._image is None:
+            self._image = Image.open(BytesIO(self.image_bytes))
+        return self._image
 
 
 class SpotifyAlbum:
-    def __init__(self, name, artists, genres, album_art_url, tracks):
+    """
+    images: the API's `images` array. Artwork is only downloaded when album_art or get_album_art is used.
+    art_resolution: the size album_art should be closest to
+    """
+    __slots__ = ('name', 'artists', 'genres', 'images', 'tracks', 'art_resolution', '_album_art')
+
+    def __init__(self, name, artists, genres, images: list[dict], tracks: list[Track], art_resolution=1024):
         self.name = name
         self.artists = artists
         self.genres = genres
+        self.images = images
         self.tracks = tracks
+        self.art_resolution = art_resolution
 
-        self.album_art: AlbumImage = self._get_album_art(album_art_url)
+        self._album_art: dict[str, AlbumImage] = {}
+
+    @property
+    def album_art(self) -> AlbumImage or None:
+        return self.get_album_art(self.art_resolution)
+
+    def get_album_art(self, resolution) -> AlbumImage or None:
+        """
+        Downloads (once) the artwork whose size is closest to resolution
+        """
+        if not self.images:
+            return None
+
+        album_art_url = min(self.images, key=lambda image: abs((image.get('width') or 0) - resolution))['url']
+        if album_art_url not in self._album_art:
+            self._album_art[album_art_url] = self._get_album_art(album_art_url)
+        return self._album_art[album_art_url]
 
     @classmethod
-    def _get_album_art(cls, album_art_url) -> Image:
-        image_bytes = requests.get(album_art_url).content
+    def _get_album_art(cls, album_art_url) -> AlbumImage:
+        image_bytes = http_session.get(album_art_url).content
         return AlbumImage(image_bytes)
 
     @classmethod
@@ -33,22 +74,27 @@ class SpotifyAlbum:
         name = api_response['name']
         artists = [artist['name'] for artist in api_response['artists']]
         genres = api_response['genres']
-        album_art_url = api_response['images'][0]['url']
-        tracks = api_response['tracks']['items']
-        return cls(name, artists, genres, album_art_url, tracks)
+        images = api_response['images']
+        tracks = [Track.from_api_response(track) for track in api_response['tracks']['items']]
+        return cls(name, artists, genres, images, tracks)
 
 
 class Spotify:
     base_url = 'https://api.spotify.com/v1/'
+    token_url = 'https://accounts.spotify.com/api/token'
+    lyrics_url = 'https://spotify-lyric-api.herokuapp.com'
 
-    def __init__(self):
+    def __init__(self, session: HttpSession = None, cache: ResponseCache = None):
+        self._session = session or http_session
+        self.cache = cache
         self._token = None
         self._refresh_at = None
+        self._token_lock = threading.Lock()
 
     def _refresh_token(self):
-        url = 'https://accounts.spotify.com/api/token'
-        data = {'grant_type': 'client_credentials', 'client_id': client_id, 'client_secret': client_secret}
-        response = requests.post(url, data=data).json()
+        data = {'grant_type': 'client_credentials', 'client_id': secret.spotify_client_id,
+                'client_secret': secret.spotify_client_secret}
+        response = self._session.post(self.token_url, data=data).json()
 
         self._token = response['access_token']
 
@@ -57,34 +103,65 @@ class Spotify:
 
     @property
     def _auth_header(self) -> dict:
-        if self._token is None or datetime.now() > self._refresh_at:
-            self._refresh_token()
+        with self._token_lock:
+            if self._token is None or datetime.now() > self._refresh_at:
+                self._refresh_token()
         return {'Authorization': f'Bearer {self._token}'}
 
-    def _make_request(self, route, params=None) -> dict:
+    def _make_request(self, route, params=None, revalidate=False) -> dict:
         """
-        Makes GET requests
+        Makes GET requests, served from the response cache when one is configured.
+        revalidate: check cached responses with the server even if they have not expired
         """
-        url = urljoin(self.base_url, route)
-        response = requests.get(url, headers=self._auth_header, params=params)
-        response.raise_for_status()
+        with instrumentation.span('spotify.request', route=route) as span:
+            content, cache_result, num_bytes = self._get(urljoin(self.base_url, route), params, revalidate)
+            span.set(cache=cache_result, bytes=num_bytes)
+        instrumentation.count('spotify_requests_total', cache=cache_result)
+        instrumentation.count('spotify_bytes_received_total', num_bytes)
+        return content
+
+    def _get(self, url, params, revalidate) -> tuple[dict, str, int]:
+        """
+        Returns the response content, how the cache was used ('off', 'hit', 'revalidated' or 'miss') and the number
+        of bytes received
+        """
+        if self.cache is None:
+            response = self._session.get(url, headers=self._auth_header, params=params)
+            response.raise_for_status()
+            return response.json(), 'off', len(response.content)
+
+        entry = self.cache.get(url, params)
+        if entry is not None and entry.is_fresh and not revalidate:
+            self.cache.served()
+            return entry.value, 'hit', 0
 
-        return response.json()
+        headers = self._auth_header
+        if entry is not None and entry.etag:
+            headers = {**headers, 'If-None-Match': entry.etag}
 
-    def get_playlists(self, user_id) -> list[dict]:
-        playlists = self._make_request(f'users/{user_id}/playlists', params={'limit': 50})
-        return playlists['items']
+        response = self._session.get(url, headers=headers, params=params)
+        if response.status_code == 304 and entry is not None:
+            self.cache.revalidated(url, params)
+            return entry.value, 'revalidated', len(response.content)
 
-    def get_tracks(self, playlist_id) -> list[dict]:
-        all_tracks = []
-        next_url = f'playlists/{playlist_id}/tracks'
-        while next_url is not None:
-            tracks = self._make_request(next_url)
-            all_tracks.extend(tracks['items'])
-            next_url = tracks['next']
+        response.raise_for_status()
+        content = response.json()
+        self.cache.put(url, params, content, etag=response.headers.get('ETag'))
+        return content, 'miss', len(response.content)
 
-        tracks = [track['track'] for track in all_tracks if track['track']]
-        return tracks
+    def get_playlists(self, user_id, revalidate=False) -> list[dict]:
+        return asyncio.run(AsyncSpotify(self).get_playlists(user_id, revalidate))
+
+    def get_playlist(self, playlist_id, fields=None, revalidate=False) -> dict:
+        """
+        fields: comma separated fields to return, e.g. 'name,snapshot_id'. Docs:
+        https://developer.spotify.com/documentation/web-api/reference/get-playlist
+        """
+        params = {'fields': fields} if fields else None
+        return self._make_request(f'playlists/{playlist_id}', params, revalidate)
+
+    def get_tracks(self, playlist_id, revalidate=False) -> TrackTable:
+        return asyncio.run(AsyncSpotify(self).get_tracks(playlist_id, revalidate))
 
     def search(self, query, types: list[str] = None):
         """
@@ -102,11 +179,26 @@ class Spotify:
         return results
 
     def get_album(self, album_href) -> SpotifyAlbum:
-        album = self._make_request(album_href)
-        return SpotifyAlbum.from_api_response(album)
+        return asyncio.run(AsyncSpotify(self).get_album(album_href))
+
+    def get_albums(self, album_ids) -> list[Album]:
+        return asyncio.run(AsyncSpotify(self).get_albums(album_ids))
+
+    def get_artists(self, artist_ids) -> list[Artist]:
+        return asyncio.run(AsyncSpotify(self).get_artists(artist_ids))
 
     def get_lyrics(self, track_id) -> list[str]:
-        response = requests.get('https://spotify-lyric-api.herokuapp.com', params={'trackid': track_id})
+        """
+        Returns an empty list if the track has no lyrics. Raises requests.HTTPError on any other failed response,
+        such as a 429 or 5xx that was still failing after retries, as that says nothing about the track.
+        """
+        with instrumentation.span('lyrics.request') as span:
+            response = self._session.get(self.lyrics_url, params={'trackid': track_id})
+            span.set(status=response.status_code, bytes=len(response.content))
+        instrumentation.count('lyrics_bytes_received_total', len(response.content))
+        if response.status_code == 404:  # The API's answer for tracks without lyrics
+            return []
+        response.raise_for_status()
         content = response.json()
         if 'lines' not in content:
             return []
@@ -115,4 +207,93 @@ class Spotify:
         return lyrics
 
 
+class AsyncSpotify:
+    """
+    asyncio interface to the Spotify API. Paginated routes read `total` from the first page and then fetch the
+    remaining pages concurrently, at most `max_concurrency` at a time. Requests go through the wrapped client's
+    _make_request on worker threads, so they share its pooled session.
+    """
+    PLAYLIST_PAGE_SIZE = 50
+    TRACK_PAGE_SIZE = 100
+    ALBUM_TRACK_PAGE_SIZE = 50
+    ALBUM_BATCH_SIZE = 20
+    ARTIST_BATCH_SIZE = 50
+
+    def __init__(self, client: Spotify = None, max_concurrency=8):
+        self._client = client or spotify
+        self.max_concurrency = max_concurrency
+
+    async def _make_request(self, route, params=None, revalidate=False) -> dict:
+        return await asyncio.to_thread(self._client._make_request, route, params, revalidate)
+
+    async def _get_all_items(self, route, page_size, first_page=None, parse_items=None, revalidate=False) -> list:
+        """
+        Returns the items of every page of a paginated route, in order.
+        parse_items: applied to each page's items as soon as the page arrives, so raw pages are not all kept
+        """
+        parse_items = parse_items or list
+        if first_page is None:
+            first_page = await self._make_request(route, {'limit': page_size, 'offset': 0}, revalidate)
+
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def get_page(offset):
+            async with semaphore:
+                page = await self._make_request(route, {'limit': page_size, 'offset': offset}, revalidate)
+            return parse_items(page['items'])
+
+        first_offset = first_page['offset'] + len(first_page['items'])
+        pages = await asyncio.gather(*[get_page(offset)
+                                       for offset in range(first_offset, first_page['total'], page_size)])
+
+        items = parse_items(first_page['items'])
+        for page in pages:
+            items.extend(page)
+        return items
+
+    async def _get_several(self, route, ids, batch_size) -> list[dict]:
+        """
+        Fetches objects from a multi-id route such as `albums?ids=`, batch_size ids per request.
+        Duplicate and missing ids are dropped; results follow the order in which ids first appear.
+        """
+        unique_ids = list(dict.fromkeys(object_id for object_id in ids if object_id))
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def get_batch(batch):
+            async with semaphore:
+                return await self._make_request(route, {'ids': ','.join(batch)})
+
+        responses = await asyncio.gather(*[get_batch(unique_ids[i:i + batch_size])
+                                           for i in range(0, len(unique_ids), batch_size)])
+        return [item for response in responses for item in response[route] if item]
+
+    async def get_playlists(self, user_id, revalidate=False) -> list[dict]:
+        return await self._get_all_items(f'users/{user_id}/playlists', self.PLAYLIST_PAGE_SIZE,
+                                         revalidate=revalidate)
+
+    async def get_tracks(self, playlist_id, revalidate=False) -> TrackTable:
+        return await self._get_all_items(f'playlists/{playlist_id}/tracks', self.TRACK_PAGE_SIZE,
+                                         parse_items=TrackTable.from_api_response, revalidate=revalidate)
+
+    async def search(self, query, types: list[str] = None):
+        return await asyncio.to_thread(self._client.search, query, types)
+
+    async def get_album(self, album_href) -> SpotifyAlbum:
+        album = await self._make_request(album_href)
+        album_tracks = album['tracks']
+        if album_tracks['total'] > len(album_tracks['items']):
+            tracks_route = f'albums/{album["id"]}/tracks'
+            album_tracks['items'] = await self._get_all_items(tracks_route, self.ALBUM_TRACK_PAGE_SIZE,
+                                                              first_page=album_tracks)
+        return SpotifyAlbum.from_api_response(album)
+
+    async def get_albums(self, album_ids) -> list[Album]:
+        albums = await self._get_several('albums', album_ids, self.ALBUM_BATCH_SIZE)
+        return [Album.from_api_response(album) for album in albums]
+
+    async def get_artists(self, artist_ids) -> list[Artist]:
+        artists = await self._get_several('artists', artist_ids, self.ARTIST_BATCH_SIZE)
+        return [Artist.from_api_response(artist) for artist in artists]
+
+
 spotify = Spotify()
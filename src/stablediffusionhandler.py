@@ -1,27 +1,35 @@
 import base64
+import binascii
 import io
-import os
+import json
+from concurrent.futures import Future
 from datetime import datetime
 from time import time
 from urllib.parse import urljoin
 
-import requests
-from PIL import Image, PngImagePlugin
-
+from src.httpsession import HttpSession
+from src.instrumentation import instrumentation
+from src.lazyimport import LazyModule
+from src.sddispatcher import SDDispatcher
+from src.imagewriter import ImageWriter, image_writer
 from src.spotifyhandler import AlbumImage
 
+Image = LazyModule('PIL.Image')
+PngImagePlugin = LazyModule('PIL.PngImagePlugin')
+
 
 class SDImage:
     def __init__(self, image, png_info):
         self.image = image
         self.png_info = png_info
 
-    def save(self, file_name):
-        file_name += '_' + datetime.now().strftime('%Y-%m-%d_%H-%M-%S') + '.png'
-        if not os.path.exists('../images'):
-            os.mkdir('../images')
-
-        self.image.save(f'../images/{file_name}', pnginfo=self.png_info)
+    def save(self, file_name, writer: ImageWriter = None) -> Future:
+        """
+        Queues the image to be written in the background by writer (default: image_writer)
+        """
+        file_name += '_' + datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+        with instrumentation.span('image.queue'):  # Blocks while the writer's queue is full
+            return (writer or image_writer).submit(self.image, file_name, self.png_info)
 
     def show(self):
         self.image.show()
@@ -29,28 +37,71 @@ class SDImage:
 
 class StableDiffusion:
     BASE_URL = 'http://127.0.0.1:7860/sdapi/v1/'
+    dispatcher: SDDispatcher = None  # Spreads requests over several backends when set, instead of using BASE_URL
+    # Generation can take minutes, and a 5xx may come after the images were made, so only 429s are retried
+    session = HttpSession(timeout=600, retry_statuses=(429,))
 
     @classmethod
     def txt2img(cls, prompt, negative_prompt, **kwargs) -> SDImage:
-        return cls._generate_image('txt2img', prompt, negative_prompt, **kwargs)
+        return cls.txt2img_batch(prompt, negative_prompt, **kwargs)[0]
+
+    @classmethod
+    def txt2img_batch(cls, prompt, negative_prompt, batch_size=1, n_iter=1, **kwargs) -> list[SDImage]:
+        """
+        Generates batch_size * n_iter images in a single request
+        """
+        return cls._generate_images(cls.request_txt2img, prompt, negative_prompt, batch_size=batch_size,
+                                    n_iter=n_iter, **kwargs)
 
     @classmethod
-    def img2img(cls, init_image: AlbumImage, prompt, negative_prompt, denoising_strength=0.6, **kwargs):
+    def img2img(cls, init_image: AlbumImage, prompt, negative_prompt, denoising_strength=0.6, **kwargs) -> SDImage:
+        return cls.img2img_batch(init_image, prompt, negative_prompt, denoising_strength, **kwargs)[0]
+
+    @classmethod
+    def img2img_batch(cls, init_image: AlbumImage, prompt, negative_prompt, denoising_strength=0.6, batch_size=1,
+                      n_iter=1, **kwargs) -> list[SDImage]:
+        """
+        Generates batch_size * n_iter images in a single request
+        """
+        return cls._generate_images(cls.request_img2img, init_image, prompt, negative_prompt,
+                                    denoising_strength=denoising_strength, batch_size=batch_size, n_iter=n_iter,
+                                    **kwargs)
+
+    @classmethod
+    def request_txt2img(cls, prompt, negative_prompt, **kwargs) -> dict:
+        """
+        Returns the raw API response; see extract_images
+        """
+        return cls._request_images('txt2img', prompt, negative_prompt, **kwargs)
+
+    @classmethod
+    def request_img2img(cls, init_image: AlbumImage, prompt, negative_prompt, denoising_strength=0.6,
+                        **kwargs) -> dict:
+        """
+        Returns the raw API response; see extract_images
+        """
         prompt = "Album art: " + prompt
         image_bytes_64 = base64.b64encode(init_image.image_bytes).decode('utf-8')
-        return cls._generate_image('img2img', prompt, negative_prompt, init_images=[image_bytes_64],
+        return cls._request_images('img2img', prompt, negative_prompt, init_images=[image_bytes_64],
                                    denoising_strength=denoising_strength, **kwargs)
 
     @classmethod
-    def _generate_image(cls, mode: str, prompt: str, negative_prompt: str,
+    def _generate_images(cls, request, *args, **kwargs) -> list[SDImage]:
+        t0 = time()
+        print('\nGenerating image with Stable Diffusion...', end='')
+        response = request(*args, **kwargs)
+        images = cls.extract_images(response)
+        print(f' Done! ({time() - t0:.2f}s)')
+        return images
+
+    @classmethod
+    def _request_images(cls, mode: str, prompt: str, negative_prompt: str,
                         model_checkpoint='sd_xl_base_1.0.safetensors', width=1024, height=1024, steps=30, cfg_scale=7,
-                        seed=-1, save_images=True,
-                        **kwargs) -> SDImage:
+                        seed=-1, save_images=True, batch_size=1, n_iter=1,
+                        **kwargs) -> dict:
         """
         mode: 'txt2img' or 'img2img'
         """
-        t0 = time()
-        print('\nGenerating image with Stable Diffusion...', end='')
         payload = {
             "sd_model_checkpoint": model_checkpoint,
             "enable_hr": False,
@@ -58,8 +109,8 @@ class StableDiffusion:
             "prompt": prompt,
             "seed": seed,
             "sampler_name": "DPM++ 2M Karras",
-            "batch_size": 1,
-            "n_iter": 1,
+            "batch_size": batch_size,
+            "n_iter": n_iter,
             "steps": steps,
             "cfg_scale": cfg_scale,
             "width": width,
@@ -71,29 +122,71 @@ class StableDiffusion:
             "save_images": save_images,
             **kwargs
         }
-        response = cls._make_request(mode, payload)
-        image = cls._extract_image(response)
-        print(f' Done! ({time() - t0:.2f}s)')
-        return image
+        return cls._make_request(mode, payload)
 
     @classmethod
     def _make_request(cls, route, payload):
-        url = urljoin(cls.BASE_URL, route)
-        response = requests.post(url, json=payload)
+        num_images = payload.get('batch_size', 1) * payload.get('n_iter', 1)
+        with instrumentation.span('sd.request', route=route, images=num_images) as span:
+            if cls.dispatcher is not None:
+                response = cls.dispatcher.post(route, payload)
+            else:
+                response = cls.session.post(urljoin(cls.BASE_URL, route), json=payload)
+            span.set(url=response.url, status=response.status_code, bytes=len(response.content))
+        instrumentation.count('sd_requests_total', route=route, status=response.status_code)
+        instrumentation.count('sd_bytes_received_total', len(response.content))
         return response.json()
 
     @classmethod
-    def _extract_image(cls, api_response) -> SDImage:
-        image_byte_str = api_response['images'][0]
-        image_bytes = io.BytesIO(base64.b64decode(image_byte_str.split(",", 1)[0]))
-        image = Image.open(image_bytes)
+    def extract_images(cls, api_response) -> list[SDImage]:
+        """
+        Decodes the images of a txt2img or img2img response, leaving out the grid image of a multi-image request
+        """
+        images = api_response['images']
+        infotexts = cls._get_infotexts(api_response)
+        if len(infotexts) != len(images):
+            infotexts = [None] * len(images)
 
-        png_payload = {
-            "image": "data:image/png;base64," + image_byte_str
-        }
-        png_response = cls._make_request('png-info', png_payload)
+        parameters = api_response.get('parameters') or {}
+        num_images = parameters.get('batch_size', 1) * parameters.get('n_iter', 1)
+        first_image = max(len(images) - num_images, 0)  # Skip the grid image the webui puts first
+
+        return [cls._extract_image(image_byte_str, infotext)
+                for image_byte_str, infotext in zip(images[first_image:], infotexts[first_image:])]
+
+    @classmethod
+    def _extract_image(cls, image_byte_str: str, infotext: str = None) -> SDImage:
+        """
+        infotext: the generation parameters. Read from the PNG's own text chunk if not given.
+        """
+        with instrumentation.span('sd.decode', chars=len(image_byte_str)):
+            image = Image.open(io.BytesIO(cls._decode_base64(image_byte_str)))
+        if infotext is None:
+            infotext = image.info.get('parameters', '')
 
         png_info = PngImagePlugin.PngInfo()
-        png_info.add_text("parameters", png_response.get("info"))
+        png_info.add_text("parameters", infotext)
 
         return SDImage(image, png_info)
+
+    @classmethod
+    def _get_infotexts(cls, api_response) -> list[str]:
+        """
+        The webui returns the parameters of every image in the `info` JSON string, so they do not need to be
+        requested from /png-info
+        """
+        try:
+            return json.loads(api_response.get('info') or '{}').get('infotexts') or []
+        except ValueError:
+            return []
+
+    @classmethod
+    def _decode_base64(cls, image_byte_str: str) -> bytes:
+        """
+        Decodes base64 image data, with or without a data URL prefix. Plain data is decoded without copying the
+        string; stripping a prefix copies the payload once.
+        """
+        header_end = image_byte_str.find(',', 0, 64)
+        if header_end == -1:
+            return binascii.a2b_base64(image_byte_str)  # ASCII strings are read in place
+        return binascii.a2b_base64(image_byte_str[header_end + 1:])
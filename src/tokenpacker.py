@@ -0,0 +1,84 @@
+import re
+from functools import lru_cache
+
+from src.lazyimport import LazyModule
+
+tiktoken = LazyModule.optional('tiktoken')
+
+
+class TokenPacker:
+    """
+    Counts tokens with tiktoken (or a characters-per-token estimate if it is not installed) and packs lists of
+    titles or summaries into a token budget.
+    """
+    DEFAULT_ENCODING = 'cl100k_base'
+    CHARS_PER_TOKEN = 4
+    TOKENS_PER_MESSAGE = 4
+    TOKENS_PER_REPLY = 3
+
+    _TITLE_VARIANT = re.compile(
+        r'[(\[][^)\]]*\b(feat|ft|featuring|with|remaster(ed)?|version|edit|live|mono|stereo|single)\b[^)\]]*[)\]]'
+        r'|\s+-\s+.*\b(remaster(ed)?|version|edit|live|mono|stereo|single)\b.*$'
+        r'|\s+(feat|ft|featuring)\.?\s.*$',
+        re.IGNORECASE)
+
+    @classmethod
+    def count_tokens(cls, text: str, model: str) -> int:
+        return cls._count_tokens(text, model)
+
+    @classmethod
+    def count_message_tokens(cls, messages: list[dict], model: str) -> int:
+        tokens = cls.TOKENS_PER_REPLY
+        for message in messages:
+            tokens += cls.TOKENS_PER_MESSAGE + cls.count_tokens(message['content'], model)
+        return tokens
+
+    @classmethod
+    def pack(cls, items: list[str], token_budget: int, model: str, separator=', ') -> tuple[list[str], int]:
+        """
+        Takes items in order, skipping any that no longer fit, until the budget is full.
+        Returns the packed items and the number of tokens they use once joined with separator.
+        """
+        separator_tokens = cls.count_tokens(separator, model)
+        packed = []
+        tokens_used = 0
+        for item in items:
+            cost = cls.count_tokens(item, model) + (separator_tokens if packed else 0)
+            if tokens_used + cost > token_budget:
+                continue
+            packed.append(item)
+            tokens_used += cost
+            if tokens_used == token_budget:
+                break
+        return packed, tokens_used
+
+    @classmethod
+    def dedupe_titles(cls, titles: list[str]) -> list[str]:
+        """
+        Drops near-identical titles, e.g. remasters, live versions and "feat." variants. Each remaining title has
+        its variant suffix removed.
+        """
+        seen = set()
+        unique_titles = []
+        for title in titles:
+            title = cls._TITLE_VARIANT.sub('', title).strip() or title
+            key = ' '.join(re.sub(r'[^\w\s]', ' ', title.lower()).split())
+            if key not in seen:
+                seen.add(key)
+                unique_titles.append(title)
+        return unique_titles
+
+    @staticmethod
+    @lru_cache(maxsize=65536)
+    def _count_tokens(text: str, model: str) -> int:
+        if tiktoken is None:
+            return max(1, round(len(text) / TokenPacker.CHARS_PER_TOKEN)) if text else 0
+        return len(_get_encoding(model).encode(text))
+
+
+@lru_cache(maxsize=None)
+def _get_encoding(model: str):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding(TokenPacker.DEFAULT_ENCODING)
@@ -5,9 +5,13 @@ class UserInterface:
         if user_id_or_link == '':
             user_id_or_link = 'https://open.spotify.com/user/1245938457'  # Use my profile as default
 
-        user_id_or_link = user_id_or_link.split('/')[-1]
-        user_id_or_link = user_id_or_link.split('?')[0]
-        return user_id_or_link
+        return cls.parse_spotify_id(user_id_or_link)
+
+    @classmethod
+    def parse_spotify_id(cls, id_or_link: str) -> str:
+        id_or_link = id_or_link.split('/')[-1]
+        id_or_link = id_or_link.split('?')[0]
+        return id_or_link
 
     @classmethod
     def choose_playlist(cls, playlists: list[dict]) -> str:
@@ -26,6 +30,16 @@ class UserInterface:
         print('\nHere is your prompt:\n')
         print(prompt)
 
+    @classmethod
+    def display_prompt_stream(cls, prompt_stream) -> str:
+        print('\nHere is your prompt:\n')
+        for token in prompt_stream:
+            print(token, end='', flush=True)
+        packed = f', packed: {prompt_stream.packed_tokens}' if prompt_stream.packed_tokens is not None else ''
+        print(f'\n\n(First token: {prompt_stream.time_to_first_token or 0:.2f}s,'
+              f' total: {prompt_stream.total_time:.2f}s, prompt tokens: {prompt_stream.prompt_tokens}{packed})')
+        return prompt_stream.read()
+
     @classmethod
     def should_continue(cls) -> bool:
         should_continue = cls._boolean_check('\nWould you like to continue?')